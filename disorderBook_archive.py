@@ -0,0 +1,330 @@
+# Closed orders never change again, so there's no need to keep them around as full Order objects
+# (plus a list of fill dicts each). The archive packs them into typed arrays instead, one column
+# per field, in chunks of consecutive order ids. An order's position in its chunk is its id modulo
+# the chunk size, so looking one up is just indexing. Fills are packed into per-chunk columns too,
+# with each order remembering where its run of fills starts and how long it is.
+#
+# The archive is only storage: it knows nothing about what the codes it stores mean. The book
+# turns rows back into Stockfighter-style dicts.
+
+import array
+import json
+import queue
+import sqlite3
+import threading
+import time
+
+CHUNK_SIZE = 4096
+SPILL_RETRY_SECS = 1.0
+
+
+def int_column(n):
+    return array.array("q", bytes(8 * n))
+
+
+def time_column(n, lazy):       # Lazy clocks give integer nanoseconds, eager ones give strings
+    if lazy:
+        return int_column(n)
+    return [None] * n
+
+
+class ArchiveChunk ():
+    def __init__(self, lazy_times):
+        n = CHUNK_SIZE
+        self.lazy_times = lazy_times
+        self.account = array.array("q", [-1]) * n     # Account number, or -1 if not archived (yet)
+        self.direction = bytearray(n)
+        self.order_type = bytearray(n)
+        self.price = int_column(n)
+        self.original_qty = int_column(n)
+        self.total_filled = int_column(n)
+        self.ts = time_column(n, lazy_times)
+        self.fill_start = int_column(n)
+        self.fill_count = int_column(n)
+        self.fill_price = int_column(0)
+        self.fill_qty = int_column(0)
+        self.fill_ts = time_column(0, lazy_times)
+        self.count = 0                                  # Orders archived in this chunk
+
+    def __contains__(self, slot):
+        return self.account[slot] != -1
+
+
+class OrderArchive ():
+    def __init__(self, lazy_times = True):
+        self.lazy_times = lazy_times
+        self.chunks = dict()            # id // CHUNK_SIZE ---> ArchiveChunk
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, id):
+        chunk = self.chunks.get(id // CHUNK_SIZE)
+        return chunk is not None and (id % CHUNK_SIZE) in chunk
+
+    def add(self, id, account, direction, order_type, price, original_qty, total_filled, ts, fill_columns, ranges):
+        # The order's fills are copied a slice at a time from fill_columns, which is (prices, qtys,
+        # times) of the same types as the chunk's own columns; ranges says which rows, as start,
+        # end, start, end... (or is None if there are none).
+
+        chunk_number, slot = divmod(id, CHUNK_SIZE)
+        chunk = self.chunks.get(chunk_number)
+        if chunk is None:
+            chunk = ArchiveChunk(self.lazy_times)
+            self.chunks[chunk_number] = chunk
+
+        chunk.account[slot] = account
+        chunk.direction[slot] = direction
+        chunk.order_type[slot] = order_type
+        chunk.price[slot] = price
+        chunk.original_qty[slot] = original_qty
+        chunk.total_filled[slot] = total_filled
+        chunk.ts[slot] = ts
+
+        fill_qty = chunk.fill_qty
+        first = len(fill_qty)
+        chunk.fill_start[slot] = first
+        if ranges:
+            prices, qtys, times = fill_columns
+            for i in range(0, len(ranges), 2):
+                start, end = ranges[i], ranges[i + 1]
+                chunk.fill_price.extend(prices[start:end])
+                fill_qty.extend(qtys[start:end])
+                chunk.fill_ts.extend(times[start:end])
+        chunk.fill_count[slot] = len(fill_qty) - first
+
+        chunk.count += 1
+        self.count += 1
+
+    def add_filled(self, orders, account_numbers, direction, order_type, fill_ts):
+        # Many closed orders at once, all of the same direction and type, each with exactly one fill:
+        # the whole of its total_filled, at its own price, at fill_ts. That's every order a sweep
+        # takes out which had never traded before, so big sweeps come here rather than to add().
+        # orders can be anything with id, account (a name in account_numbers), price, original_qty,
+        # total_filled and ts. Everything is done in one pass over them, with each chunk's columns
+        # looked up once per run of orders in the same chunk, and its fill times extended once.
+
+        chunk_number = -1
+        first = 0                       # Where the current chunk's run of orders started
+
+        for n, order in enumerate(orders):
+            number, slot = divmod(order.id, CHUNK_SIZE)
+            if number != chunk_number:
+                if n:
+                    chunk.fill_ts.extend([fill_ts] * (n - first))
+                    chunk.count += n - first
+                chunk = self.chunks.get(number)
+                if chunk is None:
+                    chunk = ArchiveChunk(self.lazy_times)
+                    self.chunks[number] = chunk
+                chunk_number = number
+                first = n
+                accounts, directions, order_types = chunk.account, chunk.direction, chunk.order_type
+                prices, original_qtys, total_filleds, times = chunk.price, chunk.original_qty, chunk.total_filled, chunk.ts
+                fill_starts, fill_counts = chunk.fill_start, chunk.fill_count
+                fill_prices, fill_qtys = chunk.fill_price, chunk.fill_qty
+            price = order.price
+            total_filled = order.total_filled
+            accounts[slot] = account_numbers[order.account]
+            directions[slot] = direction
+            order_types[slot] = order_type
+            prices[slot] = price
+            original_qtys[slot] = order.original_qty
+            total_filleds[slot] = total_filled
+            times[slot] = order.ts
+            fill_starts[slot] = len(fill_qtys)
+            fill_counts[slot] = 1
+            fill_prices.append(price)
+            fill_qtys.append(total_filled)
+
+        if orders:
+            chunk.fill_ts.extend([fill_ts] * (len(orders) - first))
+            chunk.count += len(orders) - first
+        self.count += len(orders)
+
+    def account_of(self, id):           # Returns None if the id isn't archived
+        chunk = self.chunks.get(id // CHUNK_SIZE)
+        if chunk is None:
+            return None
+        account = chunk.account[id % CHUNK_SIZE]
+        if account == -1:
+            return None
+        return account
+
+    def get(self, id):
+        # Returns (account, direction, order_type, price, original_qty, total_filled, ts, fills)
+        # with fills as a list of (price, qty, ts). Raises KeyError if the id isn't archived.
+
+        chunk = self.chunks.get(id // CHUNK_SIZE)
+        slot = id % CHUNK_SIZE
+        if chunk is None or slot not in chunk:
+            raise KeyError(id)
+
+        start = chunk.fill_start[slot]
+        end = start + chunk.fill_count[slot]
+        fills = list(zip(chunk.fill_price[start:end], chunk.fill_qty[start:end], chunk.fill_ts[start:end]))
+
+        return (chunk.account[slot], chunk.direction[slot], chunk.order_type[slot], chunk.price[slot],
+                chunk.original_qty[slot], chunk.total_filled[slot], chunk.ts[slot], fills)
+
+    def drop_chunk(self, chunk_number):
+        chunk = self.chunks.pop(chunk_number, None)
+        if chunk is not None:
+            self.count -= chunk.count
+
+
+# Optionally, old orders can be spilled to an SQLite file so that a long-running server doesn't
+# keep growing. A book hands over whole chunks of ids once they are old enough, plus single rows
+# for orders from those chunks that close later on. Each row is the full state of the order at
+# the time (orders still open when their chunk goes are written too, and simply overwritten when
+# they close), with its fills as a JSON list of [price, qty, ts]. Accounts are stored as JSON too,
+# as the journal does, since without authentication an account can be any hashable JSON value
+# (null, a number...), and should come back as the same value it went in as.
+#
+# Writing happens on a background thread, in batches, one transaction per batch. A book must keep
+# whatever it handed over readable in memory until flushed() says the batch has been written;
+# after that, get() and get_account() will find it on disk. A batch that fails to commit (disk
+# full, database locked...) is retried until it goes through, with everything after it waiting
+# in line, so nothing counts as written that isn't; meanwhile the books just keep more in memory.
+# Errors that no amount of retrying will fix (a row the database rejects) are different: the batch
+# is written row by row instead, and any rows that still fail are reported and dropped, rather than
+# holding up everything behind them for good.
+
+ROW_FIELDS = ("venue", "symbol", "id", "account", "direction", "order_type", "price", "original_qty",
+              "qty", "total_filled", "open", "ts", "fills")
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS orders (
+        venue TEXT NOT NULL,
+        symbol TEXT NOT NULL,
+        id INTEGER NOT NULL,
+        account TEXT NOT NULL,
+        direction INTEGER NOT NULL,
+        order_type INTEGER NOT NULL,
+        price INTEGER NOT NULL,
+        original_qty INTEGER NOT NULL,
+        qty INTEGER NOT NULL,
+        total_filled INTEGER NOT NULL,
+        open INTEGER NOT NULL,
+        ts,
+        fills TEXT NOT NULL,
+        PRIMARY KEY (venue, symbol, id)
+    );
+    CREATE INDEX IF NOT EXISTS orders_by_account ON orders (venue, account, symbol, id);
+    CREATE INDEX IF NOT EXISTS orders_by_time ON orders (venue, symbol, ts);
+"""
+
+INSERT = "INSERT OR REPLACE INTO orders ({}) VALUES ({})".format(", ".join(ROW_FIELDS), ", ".join("?" * len(ROW_FIELDS)))
+SELECT = "SELECT {} FROM orders".format(", ".join(ROW_FIELDS))
+
+PERMANENT_ERRORS = (sqlite3.IntegrityError, sqlite3.InterfaceError, sqlite3.DataError)
+
+
+def spill_row(venue, symbol, id, account, direction, order_type, price, original_qty, qty, total_filled, open, ts, fills):
+    # fills is an iterable of (price, qty, ts)
+    return (venue, symbol, id, json.dumps(account), direction, order_type, price, original_qty, qty, total_filled,
+            1 if open else 0, ts, json.dumps([list(fill) for fill in fills], separators = (",", ":")))
+
+
+def unspill_row(row):           # The inverse of spill_row(), fills coming back as a list of lists
+    row = list(row)
+    row[3] = json.loads(row[3])
+    row[10] = bool(row[10])
+    row[12] = json.loads(row[12])
+    return tuple(row)
+
+
+class SpillStore ():
+    def __init__(self, filename):
+        self.filename = filename
+        self.batches = queue.Queue()
+        self.submitted = 0          # Batches handed to the writer so far
+        self.written = 0            # Batches committed so far (only the writer thread changes this)
+        self.error = None           # Why the batch at the front of the line won't commit, if it won't
+        self.progress = threading.Condition()
+
+        # The reading connection is used from the request thread, the writing one from the writer
+        # thread; WAL mode lets the two get on with it at the same time.
+
+        self.reader = sqlite3.connect(filename, check_same_thread = False)
+        self.reader.execute("PRAGMA journal_mode = WAL")
+        self.reader.executescript(SCHEMA)
+        self.reader.commit()
+
+        self.writer_thread = threading.Thread(target = self.writer, daemon = True)
+        self.writer_thread.start()
+
+    def writer(self):
+        connection = sqlite3.connect(self.filename)
+        connection.execute("PRAGMA synchronous = NORMAL")
+        while 1:
+            rows = self.batches.get()
+            singly = False
+            while 1:
+                try:
+                    if singly:
+                        self.write_rows_singly(connection, rows)
+                    else:
+                        with connection:
+                            connection.executemany(INSERT, rows)
+                    break
+                except PERMANENT_ERRORS:
+                    singly = True
+                    continue
+                except Exception as e:
+                    if self.error is None:
+                        print("Archive database {}: writing failed ({}); retrying every {} seconds".format(
+                                self.filename, e, SPILL_RETRY_SECS))
+                    with self.progress:
+                        self.error = e
+                        self.progress.notify_all()
+                time.sleep(SPILL_RETRY_SECS)
+            if self.error is not None:
+                print("Archive database {}: writing again".format(self.filename))
+            with self.progress:
+                self.error = None
+                self.written += 1
+                self.progress.notify_all()
+
+    def write_rows_singly(self, connection, rows):
+        # For a batch that was rejected as a whole: everything that will go in goes in, in the one
+        # transaction, and the rest is dropped. Any other error goes back to the retrying.
+
+        with connection:
+            for row in rows:
+                try:
+                    connection.execute(INSERT, row)
+                except PERMANENT_ERRORS as e:
+                    print("Archive database {}: dropping order {} on {} {} ({})".format(
+                            self.filename, row[2], row[0], row[1], e))
+
+    def submit(self, rows):         # Returns a batch number to compare with flushed()
+        self.batches.put(rows)
+        self.submitted += 1
+        return self.submitted
+
+    def flushed(self):              # Batches up to and including this number have been written
+        return self.written
+
+    def wait(self):
+        # Until everything submitted so far is written. If the writer is stuck retrying, this raises
+        # its error rather than waiting for however long that takes.
+
+        with self.progress:
+            while self.written < self.submitted:
+                if self.error is not None:
+                    raise self.error
+                self.progress.wait()
+
+    def get(self, venue, symbol, id):
+        row = self.reader.execute(SELECT + " WHERE venue = ? AND symbol = ? AND id = ?", (venue, symbol, id)).fetchone()
+        if row is None:
+            raise KeyError(id)
+        return unspill_row(row)
+
+    def get_account(self, venue, symbol, account, above_id, below_id, limit = None):
+        rows = self.reader.execute(SELECT + " WHERE venue = ? AND account = ? AND symbol = ? AND id > ? AND id < ? "
+                                   "ORDER BY id LIMIT ?", (venue, json.dumps(account), symbol, above_id, below_id,
+                                   -1 if limit is None else limit))
+        return [unspill_row(row) for row in rows]
@@ -1,9 +1,19 @@
+import array
 import bisect
-import datetime
+import collections
+import contextlib
 import json
+import operator
 
+from disorderBook_archive import OrderArchive, CHUNK_SIZE, int_column, time_column, spill_row, unspill_row
+from disorderBook_clock import CLOCK
 from disorderBook_ws import WebsocketMessage, WS_Messages, TICKER, EXECUTION
 
+try:
+    import numpy
+except ImportError:
+    numpy = None            # Scoring falls back to plain Python
+
 
 EXECUTION_TEMPLATE = '''
 {{
@@ -24,134 +34,853 @@ EXECUTION_TEMPLATE = '''
 
 
 def current_timestamp():
-    ts = str(datetime.datetime.utcnow().isoformat()) + 'Z'       # Thanks to medecau for this
-    return ts
+    return CLOCK.timestamp()
+
+
+# Positions are kept as columns indexed by the book's account numbers, rather than an object
+# per account. An account only gets a position once it has been party to a trade; accounts lists
+# those account numbers in the order that happened, which is the order the scores page shows ties.
+#
+# The columns are 64-bit arrays, so NumPy can score them without copying. Should some account's
+# cents (or shares) ever outgrow 64 bits, the columns are turned into plain lists and everything
+# carries on in Python ints, just more slowly.
 
+SCORE_LIMIT = 2 ** 31       # Vectorised scoring needs price, shares below this, so NAV fits in 64 bits
 
-class Position():
+
+class Positions ():
     def __init__(self):
-        self.cents = 0
-        
-        self._shares = 0
-        self._min = 0
-        self._max = 0
-    
-    @property
-    def shares(self):
-        return self._shares
-    
-    @shares.setter
-    def shares(self, shares):
-        self._shares = shares
-        if shares < self._min:
-            self._min = shares
-        if shares > self._max:
-            self._max = shares
-    
-    @property
-    def minimum(self):
-        return self._min
-    
-    @property
-    def maximum(self):
-        return self._max
+        self.cents = int_column(0)
+        self.shares = int_column(0)
+        self.minimum = int_column(0)
+        self.maximum = int_column(0)
+        self.accounts = int_column(0)       # Account numbers that have positions, oldest first
+        self.active = bytearray()           # account number ---> 1 if it has a position
+        self.wide = False                   # Columns are lists, see widen()
 
+    def __len__(self):
+        return len(self.accounts)
 
-class Order (dict):
-    def __init__(self, **kwargs):
-        super().__init__(**kwargs)
-    
-    # All the comparisons are just for bisection insorting. Order should compare lower if it has higher
-    # priority, which is confusing but whatever. It means high priority orders are sorted first.
-    
-    def __eq__(self, other):
-        if self["price"] == other["price"] and self["ts"] == other["ts"]:
-            return True
-        else:
-            return False
-    
-    def __lt__(self, other):
-        if self["direction"] == "buy":
-            if self["price"] > other["price"]:      # We beat the other price, so we are "less" (low is better)
-                return True
-            elif self["price"] < other["price"]:    # Other price beats us, so we are "more" (high is worse)
-                return False
-            elif self["ts"] < other["ts"]:          # Our order was first, so we are "less" (low is better)
-                return True
-            else:
-                return False
-        else:
-            if self["price"] < other["price"]:      # We beat the other price, so we are "less" (low is better)
-                return True
-            elif self["price"] > other["price"]:    # Other price beats us, so we are "more" (high is worse)
-                return False
-            elif self["ts"] < other["ts"]:          # Our order was first, so we are "less" (low is better)
-                return True
-            else:
-                return False
-    
-    def __le__(self, other):
-        if self < other or self == other:
-            return True
+    def __contains__(self, number):
+        return number < len(self.active) and self.active[number] == 1
+
+    def open(self, number):                 # Make sure the account has a position
+        if number >= len(self.active):
+            more = number + 1 - len(self.active)
+            self.active += bytes(more)
+            for column in (self.cents, self.shares, self.minimum, self.maximum):
+                column.extend([0] * more)
+        if not self.active[number]:
+            self.active[number] = 1
+            self.accounts.append(number)
+
+    def trade(self, number, shares, cents):     # shares and cents are the changes, either sign
+        new_shares = self.shares[number] + shares
+        new_cents = self.cents[number] + cents
+        try:
+            self.set(number, new_shares, new_cents)
+        except OverflowError:
+            self.widen()
+            self.set(number, new_shares, new_cents)
+
+    def set(self, number, shares, cents):       # Safe to repeat if it raises half way
+        self.cents[number] = cents
+        self.shares[number] = shares
+        if shares < self.minimum[number]:
+            self.minimum[number] = shares
+        if shares > self.maximum[number]:
+            self.maximum[number] = shares
+
+    def widen(self):
+        self.cents = list(self.cents)
+        self.shares = list(self.shares)
+        self.minimum = list(self.minimum)
+        self.maximum = list(self.maximum)
+        self.wide = True
+
+    def get(self, number):                      # ---> (cents, shares, minimum, maximum)
+        return self.cents[number], self.shares[number], self.minimum[number], self.maximum[number]
+
+    def ranked(self, price):
+        # ---> list of (account number, cents, shares, minimum, maximum, nav), best nav first
+
+        if numpy is not None and not self.wide and len(self.accounts) and price < SCORE_LIMIT:
+            accounts = numpy.frombuffer(self.accounts, dtype = numpy.int64)
+            shares = numpy.frombuffer(self.shares, dtype = numpy.int64)[accounts]
+            cents = numpy.frombuffer(self.cents, dtype = numpy.int64)[accounts]
+            if shares.min() > -SCORE_LIMIT and shares.max() < SCORE_LIMIT and \
+                    cents.min() > -2 ** 62 and cents.max() < 2 ** 62:
+                nav = cents + shares * price
+                best = numpy.argsort(-nav, kind = "stable")
+                accounts = accounts[best]
+                minimum = numpy.frombuffer(self.minimum, dtype = numpy.int64)[accounts]
+                maximum = numpy.frombuffer(self.maximum, dtype = numpy.int64)[accounts]
+                return list(zip(accounts.tolist(), cents[best].tolist(), shares[best].tolist(),
+                                minimum.tolist(), maximum.tolist(), nav[best].tolist()))
+
+        ret = [(number, self.cents[number], self.shares[number], self.minimum[number], self.maximum[number],
+                self.cents[number] + self.shares[number] * price) for number in self.accounts]
+        ret.sort(key = operator.itemgetter(5), reverse = True)
+        return ret
+
+
+# Orders are stored as compact slotted records with integer codes for direction and type.
+# The Stockfighter-style dict is only built when an order is actually sent to someone.
+#
+# Time priority comes from seq, an integer the book hands out in strict arrival order, so two
+# orders can never tie the way two timestamps in the same microsecond could. The order's ts (like
+# every time the book records) is whatever CLOCK.stamp() gave, and only rendered by to_dict().
+
+BUY = 0
+SELL = 1
+
+LIMIT = 0
+MARKET = 1
+FOK = 2
+IOC = 3
+
+DIRECTION_NAMES = ("buy", "sell")
+ORDER_TYPE_NAMES = ("limit", "market", "fill-or-kill", "immediate-or-cancel")
+
+MAX_VALUE = 2 ** 63 - 1      # Prices and quantities must fit the archive's 64-bit columns
+
+SPILL_KEEP_CHUNKS = 4        # With a spill store, how many full chunks of ids to keep in memory
+SPILL_BATCH = 256            # Late rows for the spill store are handed over this many at a time
+
+DIRECTION_CODES = {"buy": BUY, "sell": SELL}
+ORDER_TYPE_CODES = {"limit": LIMIT, "market": MARKET, "fill-or-kill": FOK, "immediate-or-cancel": IOC,
+                    "fok": FOK, "ioc": IOC}     # Official Stockfighter accepts "fok" and "ioc" too
+
+
+def order_dict(venue, symbol, id, account, direction, order_type, price, original_qty, qty, total_filled, open, ts, fills):
+    # For orders that are no longer Order objects; fills is an iterable of (price, qty, ts)
+    return {
+                 "ok": True,
+              "venue": venue,
+             "symbol": symbol,
+          "direction": DIRECTION_NAMES[direction],
+        "originalQty": original_qty,
+                "qty": qty,
+              "price": price,
+          "orderType": ORDER_TYPE_NAMES[order_type],
+                 "id": id,
+            "account": account,
+                 "ts": CLOCK.render(ts),
+              "fills": [{"price": fill_price, "qty": fill_qty, "ts": CLOCK.render(fill_ts)}
+                                for fill_price, fill_qty, fill_ts in fills],
+        "totalFilled": total_filled,
+               "open": open
+    }
+
+
+class Order ():
+    __slots__ = ("id", "seq", "account", "direction", "order_type", "price", "original_qty", "qty",
+                 "total_filled", "open", "ts", "fills", "level")
+
+    def __init__(self, id, seq, account, direction, order_type, price, qty, ts):
+        self.id = id
+        self.seq = seq
+        self.account = account
+        self.direction = direction
+        self.order_type = order_type
+        self.price = price
+        self.original_qty = qty
+        self.qty = qty
+        self.total_filled = 0
+        self.open = True
+        self.ts = ts
+        self.fills = None                       # Flat list of start, end, start, end... rows in the FillStore
+        self.level = None                       # Handle to the PriceLevel the order rests in, if any
+
+    def add_fills(self, start, end):
+        fills = self.fills
+        if fills is None:
+            self.fills = [start, end]
+        elif fills[-1] == start:
+            fills[-1] = end
         else:
-            return False
-    
-    def __gt__(self, other):
-        if self <= other:
-            return False
+            fills += (start, end)
+
+    def to_dict(self, venue, symbol, fill_store):
+        return {
+                     "ok": True,
+                  "venue": venue,
+                 "symbol": symbol,
+              "direction": DIRECTION_NAMES[self.direction],
+            "originalQty": self.original_qty,
+                    "qty": self.qty,
+                  "price": self.price,
+              "orderType": ORDER_TYPE_NAMES[self.order_type],
+                     "id": self.id,
+                "account": self.account,
+                     "ts": CLOCK.render(self.ts),
+                  "fills": fill_store.dicts(self.fills),
+            "totalFilled": self.total_filled,
+                   "open": self.open
+        }
+
+
+# Fills live in one set of columns per book rather than as a dict per fill (a sweep through
+# thousands of orders would otherwise allocate thousands of dicts). Each sweep appends its fills
+# as consecutive rows; the incoming order remembers the whole run and each standing order its
+# one row, as ranges. The Stockfighter-style fill dicts are only built when someone asks.
+#
+# Closed orders take a copy of their fills into the archive, so rows are only needed while some
+# open order still points at them. Every so often the book compacts the store down to those.
+
+FILL_COMPACT_MIN = 4096             # Rows before the first compaction is considered
+
+
+class FillStore ():
+    def __init__(self, lazy_times = True):
+        self.lazy_times = lazy_times
+        self.price = int_column(0)
+        self.qty = int_column(0)
+        self.ts = time_column(0, lazy_times)
+        self.standing = int_column(0)       # Order ids of the two sides
+        self.incoming = int_column(0)
+
+    def __len__(self):
+        return len(self.qty)
+
+    def add_sweep(self, incoming_id, standings, quantities, timestamp):     # Returns the first new row
+        start = len(self.qty)
+        n = len(standings)
+        self.price.extend([standing.price for standing in standings])
+        self.qty.extend(quantities)
+        self.ts.extend([timestamp] * n)
+        self.standing.extend([standing.id for standing in standings])
+        self.incoming.extend([incoming_id] * n)
+        return start
+
+    def tuples(self, ranges):                   # ---> list of (price, qty, ts)
+        ret = []
+        if ranges:
+            for i in range(0, len(ranges), 2):
+                start, end = ranges[i], ranges[i + 1]
+                ret += zip(self.price[start:end], self.qty[start:end], self.ts[start:end])
+        return ret
+
+    def dicts(self, ranges):
+        render = CLOCK.render
+        ret = []
+        if ranges:
+            for i in range(0, len(ranges), 2):
+                start, end = ranges[i], ranges[i + 1]
+                ret += [{"price": price, "qty": qty, "ts": render(ts)}
+                                for price, qty, ts in zip(self.price[start:end], self.qty[start:end], self.ts[start:end])]
+        return ret
+
+    def compact(self, orders):
+        # Keep only the rows the given orders point at, and point them at the new rows.
+        price, qty, ts = int_column(0), int_column(0), time_column(0, self.lazy_times)
+        standing, incoming = int_column(0), int_column(0)
+        for order in orders:
+            ranges = order.fills
+            for i in range(0, len(ranges), 2):
+                start, end = ranges[i], ranges[i + 1]
+                new_start = len(qty)
+                price += self.price[start:end]
+                qty += self.qty[start:end]
+                ts += self.ts[start:end]
+                standing += self.standing[start:end]
+                incoming += self.incoming[start:end]
+                ranges[i], ranges[i + 1] = new_start, len(qty)
+        self.price, self.qty, self.ts, self.standing, self.incoming = price, qty, ts, standing, incoming
+
+
+# Cancelling an order just marks it dead and adjusts its level's counts, which is O(1). The dead
+# entry stays in the queue until something walks the level (crossing, or building the book), at
+# which point it is dropped. So that a level which is never walked can't fill up with corpses,
+# it is also compacted once the dead outnumber the living by enough that the cost amortises.
+
+class PriceLevel ():
+    def __init__(self, price):
+        self.price = price
+        self.orders = collections.deque()      # FIFO: the order at the front has time priority
+        self.live = 0                          # Open orders in the queue
+        self.dead = 0                          # Closed orders not yet compacted out of the queue
+        self.qty = 0                           # Total outstanding qty of the open orders
+
+    def append(self, order):                # Orders always arrive in seq order (new, amended or restored)
+        self.orders.append(order)
+        self.live += 1
+        self.qty += order.qty
+
+    def needs_compacting(self):             # Once the dead outnumber the living by enough to amortise it
+        return self.dead > 2 * self.live + 8
+
+    def compact(self):
+        if self.dead:
+            self.orders = collections.deque(order for order in self.orders if order.open)
+            self.dead = 0
+
+    def open_orders(self):
+        self.compact()
+        return self.orders
+
+
+# A Fenwick tree (binary indexed tree) of outstanding qty by price, so that "how much is there at
+# or below price P" costs O(log range) however deep the book is. Prices can be anything up to
+# 2 ** 31 and beyond, so the tree is stored sparsely in a dict, and its range simply doubles
+# when a price beyond it turns up (the new root node covers everything the old root did).
+#
+# Walking the tree on every insert, fill and cancel would cost more than the queries save, so
+# changes are netted off per price in a pending dict and only pushed into the tree when a query
+# needs them (or the dict gets big). Orders that come and go between queries cost nothing.
+
+class DepthIndex ():
+    def __init__(self):
+        self.size = 1 << 16                 # Covers prices 0 to size - 1
+        self.tree = dict()                  # 1-based node index ---> qty
+        self.pending = dict()               # price ---> net change not yet in the tree
+        self.total = 0
+
+    def add(self, price, qty):              # qty may be negative
+        pending = self.pending
+        pending[price] = pending.get(price, 0) + qty
+        self.total += qty
+        if len(pending) > 4096:
+            self.flush()
+
+    def flush(self):
+        tree = self.tree
+        for price, qty in self.pending.items():
+            if not qty:
+                continue
+            i = price + 1
+            while i > self.size:
+                old_root = tree.get(self.size, 0)       # The old root covers everything in the tree
+                self.size *= 2
+                if old_root:
+                    tree[self.size] = old_root
+            size = self.size
+            while i <= size:
+                n = tree.get(i, 0) + qty
+                if n:
+                    tree[i] = n
+                else:
+                    del tree[i]
+                i += i & -i
+        self.pending.clear()
+
+    def at_or_below(self, price):
+        if price < 0:
+            return 0
+        if self.pending:
+            self.flush()
+        tree = self.tree
+        i = min(price + 1, self.size)
+        ret = 0
+        while i:
+            ret += tree.get(i, 0)
+            i &= i - 1
+        return ret
+
+
+# The index of active prices on one side of the book is pluggable. Both kinds answer "what is
+# the best price" in O(1) and can list the prices best first.
+#
+# SparsePriceIndex keeps a sorted list of "sort keys". Keys are arranged so that the best price
+# always sorts last (bids use the price, asks use the negated price), so removing the best level
+# (the common case when crossing) is a cheap pop and anything else is a bisect. It copes with any
+# spread of prices, e.g. extreme_bot's random prices up to 2 ** 31.
+#
+# DensePriceIndex is a bytearray with one slot per cent across a window of prices. Adding and
+# removing a level is a single store; when the best level goes, the next one is found with
+# find() / rfind(), which is a C-speed scan. This suits the usual narrow band of prices.
+#
+# A price outside a dense window can't be indexed, so the side falls back to a sparse index
+# (see BookSide), and goes back to a fresh dense one, centred on the new prices, once it empties.
+
+DENSE_WINDOW = 1 << 16
+
+PRICE_INDEXES = ("dense", "sparse")
+
+
+class SparsePriceIndex ():
+    def __init__(self, is_bid, prices = ()):
+        self.is_bid = is_bid
+        self.keys = sorted(self.key(price) for price in prices)      # best price is last
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __iter__(self):                     # Best first
+        for key in reversed(self.keys):
+            yield self.key(key)             # key() is its own inverse
+
+    def key(self, price):
+        return price if self.is_bid else -price
+
+    def covers(self, price):
+        return True
+
+    def best(self):
+        if not self.keys:
+            return None
+        return self.key(self.keys[-1])
+
+    def add(self, price):
+        bisect.insort(self.keys, self.key(price))
+
+    def remove(self, price):
+        key = self.key(price)
+        if self.keys[-1] == key:
+            self.keys.pop()
         else:
-            return True
-    
-    def __ge__(self, other):
-        if self > other or self == other:
-            return True
+            del self.keys[bisect.bisect_left(self.keys, key)]
+
+
+class DensePriceIndex ():
+    def __init__(self, is_bid, centre, size = DENSE_WINDOW):
+        self.is_bid = is_bid
+        self.base = max(0, centre - size // 2)
+        self.slots = bytearray(size)        # 1 where a level exists at base + slot
+        self.count = 0
+        self.best_slot = -1
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):                     # Best first
+        slots = self.slots
+        i = self.best_slot
+        if self.count == 0:
+            return
+        if self.is_bid:
+            while i != -1:
+                yield self.base + i
+                i = slots.rfind(1, 0, i)
         else:
-            return False
-    
-    def __ne__(self, other):
-        if not self == other:
-            return True
+            while i != -1:
+                yield self.base + i
+                i = slots.find(1, i + 1)
+
+    def covers(self, price):
+        return 0 <= price - self.base < len(self.slots)
+
+    def best(self):
+        if self.count == 0:
+            return None
+        return self.base + self.best_slot
+
+    def add(self, price):
+        i = price - self.base
+        self.slots[i] = 1
+        self.count += 1
+        if self.count == 1 or (i > self.best_slot if self.is_bid else i < self.best_slot):
+            self.best_slot = i
+
+    def remove(self, price):
+        i = price - self.base
+        self.slots[i] = 0
+        self.count -= 1
+        if i == self.best_slot:
+            if self.count == 0:
+                self.best_slot = -1
+            elif self.is_bid:
+                self.best_slot = self.slots.rfind(1, 0, i)
+            else:
+                self.best_slot = self.slots.find(1, i + 1)
+
+
+# Each side of the book is a ladder of price levels. The levels live in a dict keyed by price,
+# and one of the indexes above keeps track of which prices are active and which is best.
+#
+# The side also keeps its total depth, and each level its total qty, up to date as orders are
+# added, filled and cancelled, so the quote never needs to look at individual orders. Finally
+# the DepthIndex answers cumulative depth queries, e.g. for fill-or-kill.
+
+class BookSide ():
+    def __init__(self, is_bid, price_index = "dense"):
+        if price_index not in PRICE_INDEXES:
+            raise ValueError("Unknown price index: {}".format(price_index))
+        self.is_bid = is_bid
+        self.dense = price_index == "dense"     # Prefer a dense index when the prices allow it
+        self.levels = dict()            # price ---> PriceLevel
+        self.index = SparsePriceIndex(is_bid)
+        self.depth = 0                  # Total outstanding qty on this side
+        self.depth_index = DepthIndex()
+
+    def __bool__(self):
+        return bool(self.levels)
+
+    def best_level(self):
+        price = self.index.best()
+        if price is None:
+            return None
+        return self.levels[price]
+
+    def best_price(self):
+        return self.index.best()
+
+    def iter_levels(self):
+        levels = self.levels
+        for price in self.index:
+            yield levels[price]
+
+    def index_price(self, price):
+        index = self.index
+        if not index.covers(price):
+            if self.dense and not self.levels:
+                index = DensePriceIndex(self.is_bid, price)
+            else:
+                index = SparsePriceIndex(self.is_bid, self.levels)    # Fall back
+            self.index = index
+        elif self.dense and not self.levels and index.__class__ is SparsePriceIndex:
+            index = DensePriceIndex(self.is_bid, price)                 # Emptied since falling back
+            self.index = index
+        index.add(price)
+
+    def acceptable(self, price, limit):         # Would an incoming order with this limit trade at this price?
+        return price >= limit if self.is_bid else price <= limit
+
+    def available(self, limit):                 # Total qty an incoming order with this limit could trade with
+        if self.is_bid:
+            return self.depth - self.depth_index.at_or_below(limit - 1)
         else:
-            return False
+            return self.depth_index.at_or_below(limit)
+
+    def insert(self, order):
+        price = order.price
+        level = self.levels.get(price)
+        if level is None:
+            level = PriceLevel(price)
+            self.index_price(price)
+            self.levels[price] = level
+        level.append(order)
+        order.level = level
+        self.depth += order.qty
+        self.depth_index.add(price, order.qty)
+
+    def remove_level(self, level):
+        self.index.remove(level.price)
+        del self.levels[level.price]
+
+    def reduce(self, level, qty):          # Some of the level's qty was filled
+        level.qty -= qty
+        self.depth -= qty
+        self.depth_index.add(level.price, -qty)
+
+    def remove(self, order, compact = True):      # Caller must mark the order closed, but not zero its qty, first
+        level = order.level
+        order.level = None
+        level.live -= 1
+        level.dead += 1
+        level.qty -= order.qty
+        self.depth -= order.qty
+        self.depth_index.add(level.price, -order.qty)
+        if level.live == 0:
+            self.remove_level(level)
+        elif compact and level.needs_compacting():
+            level.compact()
 
 
-# For the orderbook itself, the general plan is to keep a list of bids and a list of asks,
-# always *kept* sorted (never sorted as a whole), with the top priority order first in line.
-# Incoming orders can then just iterate through the list until they're finished crossing.
+# For the orderbook itself, the general plan is to keep a ladder of price levels for each side,
+# each level being a FIFO queue of orders. Incoming orders can then just walk the ladder from
+# the best level until they're finished crossing.
 
 class OrderBook ():
-    def __init__(self, venue, symbol, websockets_flag):
+    def __init__(self, venue, symbol, websockets_flag, check_aggregates = False, price_index = "dense", spill = None):
         self.venue = str(venue)
         self.symbol = str(symbol)
         self.websockets_flag = websockets_flag
+        self.check = check_aggregates           # Debug mode: verify the running totals after every change
         self.starttime = current_timestamp()
-        self.bids = []
-        self.asks = []
-        self.id_lookup_table = dict()            # order id ---> order object
-        self.account_order_lists = dict()        # account name ---> list of order objects
+        self.bids = BookSide(is_bid = True, price_index = price_index)
+        self.asks = BookSide(is_bid = False, price_index = price_index)
+        self.id_lookup_table = dict()            # order id ---> order object, for open orders only
+        self.archive = OrderArchive(CLOCK.lazy)  # Everything else, packed into arrays by id
+        self.fill_store = FillStore(CLOCK.lazy)  # Fills of open orders (and some stale ones); see FillStore
+        self.fill_compact_at = FILL_COMPACT_MIN
+        self.account_numbers = dict()            # account name ---> small integer, as used by the archive
+        self.account_names = []                  # small integer ---> account name
+        self.account_order_lists = dict()        # account name ---> array of order ids (not yet spilled)
+        self.account_open_orders = dict()        # account name ---> dict: order id ---> open order object
+        self.account_open_ids = dict()           # account name ---> array of those ids, ascending; see add_open_order()
+        self.spill = spill                       # Optional SpillStore for old orders; see spill_old_chunks()
+        self.spilled_below = 0                   # Every id below this has been handed to the store
+        self.spill_pending = dict()              # order id ---> spill row, for late rows not yet written
+        self.spill_waiting = collections.deque() # (batch number, chunk number or None, ids) not yet written
+        self.spill_buffer = []                   # Late rows not yet handed to the store
         self.next_id = 0
+        self.next_seq = 0                        # Time priority; see Order
         self.quote = dict()
-        self.positions = dict()
+        self.ticker_held = 0                     # See ticker_deferred()
+        self.ticker_owed = False
+        self.positions = Positions()             # Indexed by account number
         
         self.init_quote()
 
 
     def account_from_order_id(self, id):
         try:
-            return self.id_lookup_table[id]["account"]
+            return self.id_lookup_table[id].account
         except KeyError:
-            return None
+            pass
+        account_number = self.archive.account_of(id)
+        if account_number is not None:
+            return self.account_names[account_number]
+        if 0 <= id < self.spilled_below:
+            try:
+                return self.spilled_row(id)[3]
+            except KeyError:
+                pass
+        return None
+
+
+    def account_number(self, account):
+        try:
+            return self.account_numbers[account]
+        except KeyError:
+            account_number = len(self.account_names)
+            self.account_numbers[account] = account_number
+            self.account_names.append(account)
+            self.account_order_lists[account] = array.array("q")
+            self.account_open_orders[account] = dict()
+            self.account_open_ids[account] = array.array("q")
+            return account_number
 
 
-    def cleanup_closed_bids(self):
-        self.bids = [bid for bid in self.bids if bid["open"]]
+    def add_open_order(self, order):
+        # For a new order, which always has the highest id yet. account_open_ids is sorted, so the
+        # open-only listing can start at its cursor with a bisect. Closing an order leaves its id in
+        # place, as deleting from the middle of a big array on every cancel would cost more; the
+        # dead ids are compacted out once they outnumber the open ones by enough to amortise it.
+
+        open_orders = self.account_open_orders[order.account]
+        ids = self.account_open_ids[order.account]
+        if len(ids) > 3 * len(open_orders) + 8:
+            ids = array.array("q", [id for id in ids if id in open_orders])
+            self.account_open_ids[order.account] = ids
+        ids.append(order.id)
+        open_orders[order.id] = order
+
+
+    def archive_order(self, order):              # The order must be closed and off the ladder already
+        self.id_lookup_table.pop(order.id, None)
+        self.account_open_orders[order.account].pop(order.id, None)
+        fill_store = self.fill_store
+        if order.id < self.spilled_below:        # Its chunk has already gone to the spill store
+            self.spill_late(spill_row(self.venue, self.symbol, order.id, order.account, order.direction,
+                                      order.order_type, order.price, order.original_qty, 0, order.total_filled,
+                                      False, order.ts, fill_store.tuples(order.fills)))
+            return
+        self.archive.add(order.id, self.account_numbers[order.account], order.direction, order.order_type,
+                         order.price, order.original_qty, order.total_filled, order.ts,
+                         (fill_store.price, fill_store.qty, fill_store.ts), order.fills)
+
+
+    def archive_taken(self, orders, timestamp):
+        # archive_order() for many standing orders at once: all just closed by the sweep at
+        # timestamp, and none with any fill from before it, so each has the one fill of its whole
+        # total_filled at its own price. Clearing a deep book closes a lot of these. settle_sweep()
+        # has already taken them out of id_lookup_table and account_open_orders, and doesn't bother
+        # giving them fill ranges, since that one fill is all there is to know.
+
+        spilled_below = self.spilled_below
+        if spilled_below:
+            for order in orders:
+                if order.id < spilled_below:            # Its chunk has already gone to the spill store
+                    self.spill_late(spill_row(self.venue, self.symbol, order.id, order.account, order.direction,
+                                              order.order_type, order.price, order.original_qty, 0,
+                                              order.total_filled, False, order.ts,
+                                              [(order.price, order.total_filled, timestamp)]))
+            orders = [order for order in orders if order.id >= spilled_below]
+            if not orders:
+                return
+
+        # In id order, the archive's columns are written front to back rather than all over the place,
+        # which is a good deal quicker than the sort...
+
+        orders.sort(key = operator.attrgetter("id"))
+        self.archive.add_filled(orders, self.account_numbers, orders[0].direction, LIMIT, timestamp)   # Only limits rest
+
+
+    def stored_dict(self, id):                   # For orders not in id_lookup_table. Could raise KeyError
+        try:
+            account_number, direction, order_type, price, original_qty, total_filled, ts, fills = self.archive.get(id)
+        except KeyError:
+            if not 0 <= id < self.spilled_below:
+                raise
+            return order_dict(*self.spilled_row(id))
+        return order_dict(self.venue, self.symbol, id, self.account_names[account_number], direction, order_type,
+                          price, original_qty, 0, total_filled, False, ts, fills)
+
+
+    # Spilling. With a SpillStore, the archive only keeps the most recent SPILL_KEEP_CHUNKS chunks
+    # of ids (plus the one being filled). Older chunks are handed to the store whole, and dropped
+    # once the store says they're written. Orders from a spilled chunk that close later on go to the
+    # store as single rows, in batches, and wait in spill_pending until written.
+
+    def spill_old_chunks(self):
+        self.collect_spilled()
+        while self.next_id - self.spilled_below > CHUNK_SIZE * (SPILL_KEEP_CHUNKS + 1):
+            first = self.spilled_below
+            rows = [self.row_for_spill(id) for id in range(first, first + CHUNK_SIZE)]
+            batch = self.spill.submit(rows)
+            self.spill_waiting.append((batch, first // CHUNK_SIZE, None))
+            self.spilled_below = first + CHUNK_SIZE
+            for ids in self.account_order_lists.values():
+                del ids[:bisect.bisect_left(ids, self.spilled_below)]
+
+
+    def row_for_spill(self, id):
+        order = self.id_lookup_table.get(id)
+        if order is not None:
+            return spill_row(self.venue, self.symbol, id, order.account, order.direction, order.order_type,
+                             order.price, order.original_qty, order.qty, order.total_filled, True, order.ts,
+                             self.fill_store.tuples(order.fills))
+        account_number, direction, order_type, price, original_qty, total_filled, ts, fills = self.archive.get(id)
+        return spill_row(self.venue, self.symbol, id, self.account_names[account_number], direction, order_type,
+                         price, original_qty, 0, total_filled, False, ts, fills)
+
+
+    def spill_late(self, row):
+        self.spill_pending[row[2]] = row
+        self.spill_buffer.append(row)
+        if len(self.spill_buffer) >= SPILL_BATCH:
+            self.submit_spill_buffer()
+
+
+    def submit_spill_buffer(self):
+        if self.spill_buffer:
+            batch = self.spill.submit(self.spill_buffer)
+            self.spill_waiting.append((batch, None, [row[2] for row in self.spill_buffer]))
+            self.spill_buffer = []
+        self.collect_spilled()
+
+
+    def flush_spill(self):                       # Wait until everything for the spill store is written
+        if self.spill is not None:
+            self.submit_spill_buffer()
+            self.spill.wait()
+            self.collect_spilled()
+
+
+    def collect_spilled(self):                   # Forget whatever the store has written by now
+        flushed = self.spill.flushed()
+        waiting = self.spill_waiting
+        while waiting and waiting[0][0] <= flushed:
+            __, chunk_number, ids = waiting.popleft()
+            if chunk_number is not None:
+                self.archive.drop_chunk(chunk_number)
+            else:
+                for id in ids:
+                    del self.spill_pending[id]
+
+
+    def spilled_row(self, id):                   # Could raise KeyError
+        row = self.spill_pending.get(id)
+        if row is None:
+            return self.spill.get(self.venue, self.symbol, id)
+        return unspill_row(row)
+
+
+    def snapshot_state(self):
+        # Everything needed to rebuild the book with restore_state(), as plain data and the book's
+        # own column objects. Resting orders are turned into columns too, oldest first, which is
+        # much quicker to save and load than the objects. The fill store is compacted first so it
+        # holds nothing loose. The caller should flush_spill() first (which a forked child can't
+        # do, having no writer thread), or rows still waiting for the spill store are left out.
+        
+        self.compact_fills()
+        
+        account_numbers = self.account_numbers
+        orders = sorted(self.id_lookup_table.values(), key = operator.attrgetter("seq"))
+        
+        return {
+                          "venue": self.venue,
+                         "symbol": self.symbol,
+                      "starttime": self.starttime,
+                        "next_id": self.next_id,
+                       "next_seq": self.next_seq,
+                  "account_names": self.account_names,
+            "account_order_lists": self.account_order_lists,
+                  "spilled_below": self.spilled_below,
+                          "quote": self.quote,
+                      "positions": self.positions,
+                     "fill_store": self.fill_store,
+                        "archive": self.archive,
+                         "orders": {
+                                  "id": array.array("q", [order.id for order in orders]),
+                                 "seq": array.array("q", [order.seq for order in orders]),
+                             "account": array.array("q", [account_numbers[order.account] for order in orders]),
+                           "direction": bytes([order.direction for order in orders]),
+                          "order_type": bytes([order.order_type for order in orders]),
+                               "price": array.array("q", [order.price for order in orders]),
+                        "original_qty": array.array("q", [order.original_qty for order in orders]),
+                                 "qty": array.array("q", [order.qty for order in orders]),
+                        "total_filled": array.array("q", [order.total_filled for order in orders]),
+                                  "ts": [order.ts for order in orders],
+                               "fills": [order.fills for order in orders],
+                   },
+        }
+    
+    
+    def restore_state(self, state):             # Only into a freshly made book
+        self.starttime = state["starttime"]
+        self.next_id = state["next_id"]
+        self.next_seq = state["next_seq"]
+        self.account_names = state["account_names"]
+        self.account_numbers = {account: number for number, account in enumerate(self.account_names)}
+        self.account_order_lists = state["account_order_lists"]
+        self.account_open_orders = {account: dict() for account in self.account_names}
+        self.account_open_ids = dict()
+        self.spilled_below = state["spilled_below"]
+        self.positions = state["positions"]
+        self.fill_store = state["fill_store"]
+        self.archive = state["archive"]
+        
+        columns = state["orders"]
+        account_names = self.account_names
+        
+        for id, seq, account_number, direction, order_type, price, original_qty, qty, total_filled, ts, fills in zip(
+                columns["id"], columns["seq"], columns["account"], columns["direction"], columns["order_type"],
+                columns["price"], columns["original_qty"], columns["qty"], columns["total_filled"],
+                columns["ts"], columns["fills"]):
+            account = account_names[account_number]
+            order = Order(id, seq, account, direction, order_type, price, qty, ts)
+            order.original_qty = original_qty
+            order.total_filled = total_filled
+            order.fills = fills
+            if direction == BUY:
+                self.bids.insert(order)
+            else:
+                self.asks.insert(order)
+            self.id_lookup_table[id] = order
+            self.account_open_orders[account][id] = order
+        
+        # The orders went in oldest first (by seq), but a live book has each account's open orders
+        # in id order, which an amended order breaks, so put them in id order...
+        
+        for account, open_orders in self.account_open_orders.items():
+            ids = sorted(open_orders)
+            self.account_open_orders[account] = {id: open_orders[id] for id in ids}
+            self.account_open_ids[account] = array.array("q", ids)
         
-    def cleanup_closed_asks(self):
-        self.asks = [ask for ask in self.asks if ask["open"]]
+        self.fill_compact_at = max(FILL_COMPACT_MIN, 2 * len(self.fill_store), len(self.id_lookup_table))
+        self.quote = state["quote"]
         
-    def cleanup_closed_orders(self):
-        self.cleanup_closed_bids()
-        self.cleanup_closed_asks()
+        if self.check:
+            self.check_aggregates()
+    
+    
+    def compact_fills(self):
+        # Only open orders still use the store. Waiting until it has grown past both twice what's
+        # left and the number of open orders keeps the cost amortised over the fills since.
+        self.fill_store.compact([order for order in self.id_lookup_table.values() if order.fills])
+        self.fill_compact_at = max(FILL_COMPACT_MIN, 2 * len(self.fill_store), len(self.id_lookup_table))
+
+
+    def get_positions(self):            # account name ---> (cents, shares, minimum, maximum)
+        return {self.account_names[number]: self.positions.get(number) for number in self.positions.accounts}
+
+
+    def get_scores(self, price):        # ---> list of [account, cents, shares, minimum, maximum, nav], best first
+        return [[self.account_names[number], cents, shares, minimum, maximum, nav]
+                        for number, cents, shares, minimum, maximum, nav in self.positions.ranked(price)]
 
 
     def get_book(self):
@@ -159,25 +888,65 @@ class OrderBook ():
         ret["ok"] = True
         ret["venue"] = self.venue
         ret["symbol"] = self.symbol
-        ret["bids"] = [{"price": order["price"], "qty": order["qty"], "isBuy": True} for order in self.bids]
-        ret["asks"] = [{"price": order["price"], "qty": order["qty"], "isBuy": False} for order in self.asks]
+        ret["bids"] = [{"price": order.price, "qty": order.qty, "isBuy": True}
+                                for level in self.bids.iter_levels() for order in level.open_orders()]
+        ret["asks"] = [{"price": order.price, "qty": order.qty, "isBuy": False}
+                                for level in self.asks.iter_levels() for order in level.open_orders()]
         ret["ts"] = current_timestamp()
         return ret
     
     
     def get_status(self, id):
-        return self.id_lookup_table[id]
+        order = self.id_lookup_table.get(id)
+        if order is not None:
+            return order.to_dict(self.venue, self.symbol, self.fill_store)
+        return self.stored_dict(id)            # Could raise KeyError
     
     
-    def get_all_orders(self, account):
-        if account in self.account_order_lists:
-            return {"ok": True, "venue": self.venue, "orders": self.account_order_lists[account]}
-        else:
+    def get_all_orders(self, account, open_only = False, since_id = -1, limit = None):
+        # Orders come back in id order, only those with ids above since_id, and at most limit of them
+        
+        if account not in self.account_order_lists:
             return {"ok": True, "venue": self.venue, "orders": []}
+        
+        if open_only:
+            open_orders = self.account_open_orders[account]
+            ids = self.account_open_ids[account]
+            orders = []
+            for i in range(bisect.bisect_right(ids, since_id), len(ids)):
+                if limit is not None and len(orders) >= limit:
+                    break
+                order = open_orders.get(ids[i])
+                if order is not None:
+                    orders.append(order.to_dict(self.venue, self.symbol, self.fill_store))
+            return {"ok": True, "venue": self.venue, "orders": orders}
+        
+        orders = []
+        
+        if since_id + 1 < self.spilled_below:
+            # The account's older ids are only in the store, so get everything written first.
+            # Rows for orders that are still open may be stale; the live order wins.
+            self.flush_spill()
+            for row in self.spill.get_account(self.venue, self.symbol, account, since_id, self.spilled_below, limit):
+                order = self.id_lookup_table.get(row[2])
+                if order is not None:
+                    orders.append(order.to_dict(self.venue, self.symbol, self.fill_store))
+                else:
+                    orders.append(order_dict(*row))
+        
+        ids = self.account_order_lists[account]
+        start = bisect.bisect_right(ids, since_id)
+        end = len(ids) if limit is None else start + max(0, limit - len(orders))
+        orders += [self.get_status(id) for id in ids[start:end]]
+        return {"ok": True, "venue": self.venue, "orders": orders}
     
 
     def get_quote(self):    # Used by the frontend for historical reasons
-        return self.quote
+        ret = dict(self.quote)
+        ret["quoteTime"] = CLOCK.render(ret["quoteTime"])
+        if "lastTrade" in ret:
+            ret["lastTrade"] = CLOCK.render(ret["lastTrade"])
+        return ret
     
 
     def init_quote(self):
@@ -191,123 +960,345 @@ class OrderBook ():
         self.quote["askDepth"] = 0
         self.quote["askSize"] = 0
         
-        self.quote["quoteTime"] = current_timestamp()
+        self.quote["quoteTime"] = CLOCK.stamp()
+
+
+    def update_quote(self, timestamp):          # Straight from the aggregates, so O(1)
+        quote = self.quote
+        
+        level = self.bids.best_level()
+        if level is None:
+            quote.pop("bid", None)
+            quote["bidSize"] = 0
+        else:
+            quote["bid"] = level.price
+            quote["bidSize"] = level.qty
+        quote["bidDepth"] = self.bids.depth
+        
+        level = self.asks.best_level()
+        if level is None:
+            quote.pop("ask", None)
+            quote["askSize"] = 0
+        else:
+            quote["ask"] = level.price
+            quote["askSize"] = level.qty
+        quote["askDepth"] = self.asks.depth
+        
+        quote["quoteTime"] = timestamp
+
+
+    def check_aggregates(self):
+        # Debug mode only: recount everything the hard way and compare with the running totals.
+        
+        for side in self.bids, self.asks:
+            depth = 0
+            for level in side.iter_levels():
+                open_orders = [order for order in level.orders if order.open]
+                if level.live != len(open_orders) or level.dead != len(level.orders) - len(open_orders):
+                    raise AssertionError("Level {} has wrong live/dead counts".format(level.price))
+                if level.live == 0:
+                    raise AssertionError("Empty level {} is still on the ladder".format(level.price))
+                if level.qty != sum(order.qty for order in open_orders):
+                    raise AssertionError("Level {} has wrong qty".format(level.price))
+                index = side.depth_index
+                if index.at_or_below(level.price) - index.at_or_below(level.price - 1) != level.qty:
+                    raise AssertionError("Depth index disagrees with level {}".format(level.price))
+                depth += level.qty
+            if side.depth != depth or side.depth_index.total != depth:
+                raise AssertionError("Side depth is {} but should be {}".format(side.depth, depth))
+            if len(side.levels) != len(side.index) or sorted(side.levels) != sorted(side.index):
+                raise AssertionError("Ladder index and levels disagree")
+        
+        quote = self.quote
+        if quote["bidDepth"] != self.bids.depth or quote["askDepth"] != self.asks.depth:
+            raise AssertionError("Quote depth is stale")
+        if quote["bidSize"] != self.bid_size() or quote["askSize"] != self.ask_size():
+            raise AssertionError("Quote size is stale")
+        if quote.get("bid") != self.bids.best_price() or quote.get("ask") != self.asks.best_price():
+            raise AssertionError("Quote price is stale")
 
         
     def bid_size(self):
-        if len(self.bids) == 0:
+        level = self.bids.best_level()
+        if level is None:
             return 0
-        ret = 0
-        bestprice = self.bids[0]["price"]
-        for order in self.bids:
-            if order["price"] == bestprice:
-                ret += order["qty"]
-            else:
-                break
-        return ret
+        return level.qty
 
         
     def ask_size(self):
-        if len(self.asks) == 0:
+        level = self.asks.best_level()
+        if level is None:
             return 0
-        ret = 0
-        bestprice = self.asks[0]["price"]
-        for order in self.asks:
-            if order["price"] == bestprice:
-                ret += order["qty"]
-            else:
-                break
-        return ret
+        return level.qty
 
 
     def fok_can_buy(self, price, qty):
-        avail = 0
-        for standing in self.asks:
-            if standing["price"] <= price:
-                avail += standing["qty"]
-                if avail >= qty:
-                    break
-            else:
-                break                # Taking advantage of list sortedness
-
-        if avail >= qty:
-            return True
-        else:
-            return False
+        return self.asks.available(price) >= qty
 
 
     def fok_can_sell(self, price, qty):
-        avail = 0
-        for standing in self.bids:
-            if standing["price"] >= price:
-                avail += standing["qty"]
-                if avail >= qty:
-                    break
-            else:
-                break                # Taking advantage of list sortedness
+        return self.bids.available(price) >= qty
 
-        if avail >= qty:
-            return True
-        else:
-            return False
+
+    def get_depth(self, price):
+        # Not part of the official API. How much could a buy or a sell with this limit trade with?
+        ret = dict()
+        ret["ok"] = True
+        ret["venue"] = self.venue
+        ret["symbol"] = self.symbol
+        ret["price"] = price
+        ret["bidDepth"] = self.bids.available(price)        # Bids at or above the price
+        ret["askDepth"] = self.asks.available(price)        # Asks at or below the price
+        ret["ts"] = current_timestamp()
+        return ret
     
     
     def cancel_order(self, id):
-        order = self.id_lookup_table[id]
+        order = self.id_lookup_table.get(id)
+        
+        if order is not None:                   # i.e. it's open
+        
+            order.open = False
+            
+            if order.direction == BUY:
+                self.bids.remove(order)
+            else:
+                self.asks.remove(order)
+            
+            order.qty = 0
+            
+            self.update_quote(CLOCK.stamp())
+            
+            ret = order.to_dict(self.venue, self.symbol, self.fill_store)
+            self.archive_order(order)
+            
+            if self.check:
+                self.check_aggregates()
         
-        if order["open"]:
+        else:
+            ret = self.stored_dict(id)          # Could raise KeyError
+            
+        if self.websockets_flag:
+            self.create_ticker_message()
+
+        return ret
+    
+    
+    def cancel_orders(self, ids):
+        # Like cancel_order() for each id in turn, but with one quote update, one ticker message,
+        # and each level compacted (if need be) once at the end. Returns a list with the order's
+        # dict for each id, or None for ids that don't exist.
         
-            qty_outstanding = order["qty"]
+        results = []
+        touched = set()                         # Levels that lost orders
+        cancelled = False
         
-            order["qty"] = 0
-            order["open"] = False
-            self.cleanup_closed_orders()
+        for id in ids:
+            order = self.id_lookup_table.get(id)
+            if order is None:
+                try:
+                    results.append(self.stored_dict(id))
+                except KeyError:
+                    results.append(None)
+                continue
             
-            # Fix the quote...
+            order.open = False
             
-            self.quote["quoteTime"] = current_timestamp()
+            touched.add(order.level)
             
-            if order["direction"] == "buy":
-                if self.bids:
-                    self.quote["bidDepth"] -= qty_outstanding
-                    
-                    bestprice = self.bids[0]["price"]
-                    
-                    if order["price"] == bestprice:
-                        self.quote["bidSize"] -= qty_outstanding
-                    elif order["price"] > bestprice:                # Best order was cancelled
-                        self.quote["bidSize"] = self.bid_size()
-                        self.quote["bid"] = self.bids[0]["price"]
-                else:
-                    self.quote["bidDepth"] = 0
-                    self.quote["bidSize"] = 0
-                    if "bid" in self.quote:
-                        self.quote.pop("bid")
+            if order.direction == BUY:
+                self.bids.remove(order, compact = False)
             else:
-                if self.asks:
-                    self.quote["askDepth"] -= qty_outstanding
-                    
-                    bestprice = self.asks[0]["price"]
-                    
-                    if order["price"] == bestprice:
-                        self.quote["askSize"] -= qty_outstanding
-                    elif order["price"] < bestprice:                # Best order was cancelled
-                        self.quote["askSize"] = self.ask_size()
-                        self.quote["ask"] = self.asks[0]["price"]
-                else:
-                    self.quote["askDepth"] = 0
-                    self.quote["askSize"] = 0
-                    if "ask" in self.quote:
-                        self.quote.pop("ask")
+                self.asks.remove(order, compact = False)
             
+            order.qty = 0
+            
+            results.append(order.to_dict(self.venue, self.symbol, self.fill_store))
+            self.archive_order(order)
+            cancelled = True
+        
+        for level in touched:
+            if level.live and level.needs_compacting():     # (Emptied levels are off the ladder already)
+                level.compact()
+        
+        if cancelled:
+            self.update_quote(CLOCK.stamp())
+            if self.check:
+                self.check_aggregates()
+        
         if self.websockets_flag:
             self.create_ticker_message()
-
-        return order
+        
+        return results
+    
+    
+    def cancel_account_orders(self, account):   # Cancels all the account's open orders; returns their dicts
+        return self.cancel_orders(list(self.account_open_orders.get(account, ())))
+    
+    
+    def amend_order(self, id, price = None, qty = None):
+        # Changes a resting order's price and/or qty in one step. qty is the new outstanding qty;
+        # originalQty moves by the same amount, so totalFilled still adds up. Shrinking an order
+        # keeps its place in the queue. A new price, or more qty, sends it to the back of the
+        # queue, as if freshly placed (and it can trade straight away if the new price crosses).
+        # Closed orders are left alone and their dict returned, as with cancel_order().
+        # The caller should be prepared to handle KeyError (no such order), TypeError and ValueError.
+        
+        # Checked even for closed orders, so that whatever comes back OK is fit to journal...
+        
+        if price is not None:
+            price = int(price)                  # Could raise TypeError
+            if price < 0 or price > MAX_VALUE:
+                raise ValueError
+        if qty is not None:
+            qty = int(qty)                      # Could raise TypeError
+            if qty <= 0 or qty > MAX_VALUE:
+                raise ValueError
+        
+        order = self.id_lookup_table.get(id)
+        if order is None:
+            return self.stored_dict(id)         # Could raise KeyError
+        
+        if price is None:
+            price = order.price
+        if qty is None:
+            qty = order.qty
+        elif qty > MAX_VALUE - order.total_filled:
+            raise ValueError
+        
+        side = self.bids if order.direction == BUY else self.asks
+        
+        if price == order.price and qty <= order.qty:
+            if qty == order.qty:
+                return order.to_dict(self.venue, self.symbol, self.fill_store)
+            shrink = order.qty - qty
+            side.reduce(order.level, shrink)
+            order.qty = qty
+            order.original_qty -= shrink
+            self.update_quote(CLOCK.stamp())
+            if self.websockets_flag:
+                self.create_ticker_message()
+        
+        else:
+            # The old object is left in its queue as a cancelled corpse, and a new one (same id,
+            # fills and so on) takes over, with a new seq.
+            
+            order.open = False
+            side.remove(order)
+            
+            seq = self.next_seq
+            self.next_seq += 1
+            
+            amended = Order(id, seq, order.account, order.direction, order.order_type, price, qty, order.ts)
+            amended.original_qty = order.total_filled + qty
+            amended.total_filled = order.total_filled
+            amended.fills = order.fills
+            order.qty = 0
+            
+            self.id_lookup_table[id] = amended
+            self.account_open_orders[amended.account][id] = amended
+            
+            self.run_order(amended)             # Rests whatever doesn't trade, updates the quote
+            
+            if not amended.open:
+                self.archive_order(amended)
+            order = amended
+        
+        if self.check:
+            self.check_aggregates()
+        
+        return order.to_dict(self.venue, self.symbol, self.fill_store)
+    
+    
+    def mass_quote(self, account, quotes):
+        # Replaces all the account's resting orders on this book with the given quotes, a list of
+        # dicts with "direction", "price" and "qty" (quotes for the same side and price add up).
+        # Where the account already has orders at a side and price, they are kept, with their
+        # priority: too much qty is trimmed from the newest orders first, too little is topped up
+        # with a new order. Everything is checked before anything changes, so the caller should be
+        # prepared to handle KeyError, TypeError and ValueError with the book untouched.
+        # Returns the dicts of the orders now quoting (in id order, including any new ones that
+        # traded on arrival) and of those cancelled.
+        
+        wanted = dict()                         # (direction, price) ---> qty
+        
+        for quote in quotes:
+            price = int(quote["price"])         # Could raise KeyError, TypeError
+            qty = int(quote["qty"])
+            direction = quote["direction"]
+            if price < 0 or price > MAX_VALUE:
+                raise ValueError
+            if qty <= 0:
+                raise ValueError
+            try:
+                direction = DIRECTION_CODES[direction]
+            except (KeyError, TypeError):
+                raise ValueError
+            key = (direction, price)
+            wanted[key] = wanted.get(key, 0) + qty
+            if wanted[key] > MAX_VALUE:
+                raise ValueError
+        
+        current = dict()                        # (direction, price) ---> open orders there, oldest first
+        for order in sorted(self.account_open_orders.get(account, dict()).values(), key = operator.attrgetter("seq")):
+            current.setdefault((order.direction, order.price), []).append(order)
+        
+        quoting = []                            # ids of orders that stay
+        cancels = []
+        shrinks = []                            # (id, new qty)
+        adds = []                               # ((direction, price), qty)
+        
+        for key, orders in current.items():
+            excess = sum(order.qty for order in orders) - wanted.get(key, 0)
+            if excess < 0:
+                adds.append((key, -excess))
+            for order in reversed(orders):
+                if excess <= 0:
+                    quoting.append(order.id)
+                elif order.qty <= excess:
+                    cancels.append(order.id)
+                    excess -= order.qty
+                else:
+                    shrinks.append((order.id, order.qty - excess))
+                    quoting.append(order.id)
+                    excess = 0
+        
+        for key, qty in wanted.items():
+            if key not in current:
+                adds.append((key, qty))
+        
+        with self.ticker_deferred():
+            cancelled = self.cancel_orders(cancels)
+            for id, qty in shrinks:
+                self.amend_order(id, qty = qty)
+            for (direction, price), qty in adds:
+                ret = self.parse_order({"account": account, "price": price, "qty": qty,
+                                        "direction": DIRECTION_NAMES[direction], "orderType": "limit"})
+                quoting.append(ret["id"])
+        
+        return {"ok": True, "venue": self.venue, "symbol": self.symbol,
+                "orders": [self.get_status(id) for id in sorted(quoting)], "cancelled": cancelled}
     
     
+    @contextlib.contextmanager
+    def ticker_deferred(self):
+        # Inside this, ticker messages are held back, and one (with the quote as it is at the end)
+        # is sent on the way out if any were wanted. Nests.
+        self.ticker_held += 1
+        try:
+            yield
+        finally:
+            self.ticker_held -= 1
+            if self.ticker_held == 0 and self.ticker_owed:
+                self.ticker_owed = False
+                self.create_ticker_message()
+
+
     def create_ticker_message(self):
-        msg = '{"ok": true, "quote": ' + json.dumps(self.quote) + '}'
+        if self.ticker_held:
+            self.ticker_owed = True
+            return
+        msg = '{"ok": true, "quote": ' + json.dumps(self.get_quote()) + '}'
         ticker_msg_obj = WebsocketMessage(account = "NONE", venue = self.venue, symbol = self.symbol, msgtype = TICKER, msg = msg)
         WS_Messages.put(ticker_msg_obj)
     
@@ -322,12 +1313,6 @@ class OrderBook ():
         except KeyError:
             orderType = data["ordertype"]    # Could re-raise KeyError
 
-        # Official stockfighter accepts "fok" and "ioc" as legit orderType:
-        if orderType == "fok":
-            orderType = "fill-or-kill"
-        elif orderType == "ioc":
-            orderType = "immediate-or-cancel"
-        
         # The following can raise KeyError:
         account = data["account"]
         price = data["price"]
@@ -341,50 +1326,40 @@ class OrderBook ():
         price = int(price)    # Could raise TypeError
         qty = int(qty)        # Could raise TypeError
         
-        if price < 0:
+        if price < 0 or price > MAX_VALUE:
             raise ValueError
-        if qty <= 0:
+        if qty <= 0 or qty > MAX_VALUE:
             raise ValueError
-        if direction not in ("buy", "sell"):
-            raise ValueError
-        if orderType not in ("limit", "market", "fill-or-kill", "immediate-or-cancel"):
+        
+        try:
+            direction = DIRECTION_CODES[direction]
+            order_type = ORDER_TYPE_CODES[orderType]
+        except (KeyError, TypeError):
             raise ValueError
 
+        self.account_number(account)                # Could raise TypeError if unhashable
+
         id = self.next_id
         self.next_id += 1
+        seq = self.next_seq
+        self.next_seq += 1
         
-        order = Order(
-                         ok = True,
-                      venue = self.venue,
-                     symbol = self.symbol,
-                  direction = direction,
-                originalQty = qty,
-                        qty = qty,
-                      price = price,
-                  orderType = orderType,
-                         id = id,
-                    account = account,
-                         ts = current_timestamp(),
-                      fills = list(),
-                totalFilled = 0,
-                       open = True
-                            )
-        
-        self.id_lookup_table[id] = order            # So we can find it for status/cancel
+        order = Order(id, seq, account, direction, order_type, price, qty, CLOCK.stamp())
         
-        if account not in self.account_order_lists:
-            self.account_order_lists[account] = list()
-        self.account_order_lists[account].append(order)        # So we can list all an account's orders
+        self.account_order_lists[account].append(id)        # So we can list all an account's orders
+
+        if self.spill is not None and id % CHUNK_SIZE == 0:
+            self.spill_old_chunks()
             
         # Limit, Market, and IOC orders are easy...
         
-        if orderType in ("limit", "immediate-or-cancel", "market"):
+        if order_type != FOK:
             self.run_order(order)
             
         # FOK orders are slightly tricky...
         
-        elif orderType == "fill-or-kill":
-            if direction == "buy":
+        else:
+            if direction == BUY:
                 if self.fok_can_buy(price = price, qty = qty):
                     self.run_order(order)
             else:
@@ -393,108 +1368,109 @@ class OrderBook ():
         
         # Limit orders may have been placed on the book, the rest may need to be closed...
         
-        if order["orderType"] != "limit":
-            order["qty"] = 0
-            order["open"] = False
+        if order_type != LIMIT:
+            order.qty = 0
+            order.open = False
+        
+        ret = order.to_dict(self.venue, self.symbol, self.fill_store)
+        
+        if order.open:
+            self.id_lookup_table[id] = order        # So we can find it for status/cancel
+            self.add_open_order(order)
+        else:
+            self.archive_order(order)
+        
+        if len(self.fill_store) > self.fill_compact_at:
+            self.compact_fills()
+        
+        if self.check:
+            self.check_aggregates()
         
-        return order
+        return ret
 
 
     def run_order(self, incoming):
     
-        incomingprice = incoming["price"]
-        timestamp = current_timestamp()
-        
-        lastprice = 0
-        lastqty = 0
+        incomingprice = incoming.price
+        timestamp = CLOCK.stamp()
     
-        if incoming["direction"] == "sell":
-            for standing in self.bids:
-                if standing["price"] >= incomingprice or incoming["orderType"] == "market":
-                    lastprice, lastqty = self.order_cross(standing = standing, incoming = incoming, timestamp = timestamp)
-                    if incoming["qty"] == 0:
-                        break
-                else:
-                    break               # Taking advantage of the sortedness of the book's lists
-            self.cleanup_closed_bids()
+        if incoming.direction == SELL:
+            opposite = self.bids
         else:
-            for standing in self.asks:
-                if standing["price"] <= incomingprice or incoming["orderType"] == "market":
-                    lastprice, lastqty = self.order_cross(standing = standing, incoming = incoming, timestamp = timestamp)
-                    if incoming["qty"] == 0:
-                        break
-                else:
-                    break               # Taking advantage of the sortedness of the book's lists
-            self.cleanup_closed_asks()
-
-        # Limit orders rest on the book (also must adjust quote for their half of the book)....
+            opposite = self.asks
+        
+        is_market = incoming.order_type == MARKET
+        
+        # First work out who trades with whom and how much, adjusting only the standing orders
+        # and the ladder. Levels that the incoming order can swallow whole are taken in one go
+        # and unlinked without being popped order by order. The bookkeeping (fills, positions,
+        # execution messages) is then done for the whole sweep at once by settle_sweep().
+        
+        standings = []          # Standing orders in the order they traded...
+        quantities = []         # ...and how much each one traded
+        remaining = incoming.qty
+        
+        while remaining and opposite:
+            level = opposite.best_level()
+            if not is_market and not opposite.acceptable(level.price, incomingprice):
+                break                   # Taking advantage of the sortedness of the ladder
+            orders = level.orders
             
-        if incoming["orderType"] == "limit":
-            if incoming["open"]:
-                if incoming["direction"] == "buy":
-                
-                    if self.bids:
-                        old_bestprice = self.bids[0]["price"]
-                    else:
-                        old_bestprice = None
+            if remaining >= level.qty:
+                for standing in orders:
+                    if standing.open:
+                        quantity = standing.qty
+                        standings.append(standing)
+                        quantities.append(quantity)
+                        standing.total_filled += quantity
+                        standing.qty = 0
+                        standing.open = False
+                        standing.level = None
+                remaining -= level.qty
+                opposite.reduce(level, level.qty)
+                opposite.remove_level(level)
                 
-                    bisect.insort(self.bids, incoming)
-                    
-                    self.quote["bidDepth"] += incoming["qty"]
-                    
-                    if incoming["price"] == old_bestprice:
-                        self.quote["bidSize"] += incoming["qty"]
-                        
-                    elif old_bestprice is None or incoming["price"] > old_bestprice:        # New order is best
-                        self.quote["bidSize"] = incoming["qty"]
-                        self.quote["bid"] = incoming["price"]
-                        
-                else:
-                
-                    if self.asks:
-                        old_bestprice = self.asks[0]["price"]
-                    else:
-                        old_bestprice = None
-                        
-                    bisect.insort(self.asks, incoming)
-                    
-                    self.quote["askDepth"] += incoming["qty"]
-                    
-                    if incoming["price"] == old_bestprice:
-                        self.quote["askSize"] += incoming["qty"]
-                        
-                    elif old_bestprice is None or incoming["price"] < old_bestprice:        # New order is best
-                        self.quote["askSize"] = incoming["qty"]
-                        self.quote["ask"] = incoming["price"]
-        
-        self.quote["quoteTime"] = timestamp         # Always do this
-        
-        # Check if there were any crosses; if so we need to do more quote setting...
-        
-        if incoming["totalFilled"]:
-            if incoming["direction"] == "sell":
-                if self.bids:
-                    self.quote["bid"] = self.bids[0]["price"]
-                    self.quote["bidSize"] = self.bid_size()
-                    self.quote["bidDepth"] -= incoming["totalFilled"]
-                else:
-                    if "bid" in self.quote:
-                        self.quote.pop("bid")
-                    self.quote["bidSize"] = 0
-                    self.quote["bidDepth"] = 0
-            else:
-                if self.asks:
-                    self.quote["ask"] = self.asks[0]["price"]
-                    self.quote["askSize"] = self.ask_size()
-                    self.quote["askDepth"] -= incoming["totalFilled"]
-                else:
-                    if "ask" in self.quote:
-                        self.quote.pop("ask")
-                    self.quote["askSize"] = 0
-                    self.quote["askDepth"] = 0
+            else:                       # Only happens once per sweep, and leaves the level alive
+                taken = remaining
+                while remaining:
+                    standing = orders[0]
+                    if not standing.open:        # Cancelled earlier, compact it out now
+                        orders.popleft()
+                        level.dead -= 1
+                        continue
+                    quantity = min(standing.qty, remaining)
+                    standings.append(standing)
+                    quantities.append(quantity)
+                    standing.qty -= quantity
+                    standing.total_filled += quantity
+                    remaining -= quantity
+                    if standing.qty == 0:
+                        standing.open = False
+                        orders.popleft()
+                        level.live -= 1
+                        standing.level = None
+                opposite.reduce(level, taken)
+        
+        if standings:
+            incoming.total_filled += incoming.qty - remaining
+            incoming.qty = remaining
+            if remaining == 0:
+                incoming.open = False
+            self.settle_sweep(incoming, standings, quantities, timestamp)
+
+        # Limit orders rest on the book...
             
-            self.quote["last"] = lastprice
-            self.quote["lastSize"] = lastqty
+        if incoming.order_type == LIMIT and incoming.open:
+            if incoming.direction == BUY:
+                self.bids.insert(incoming)
+            else:
+                self.asks.insert(incoming)
+        
+        self.update_quote(timestamp)
+        
+        if standings:
+            self.quote["last"] = standings[-1].price
+            self.quote["lastSize"] = quantities[-1]
             self.quote["lastTrade"] = timestamp
 
         # And fire off a websocket message...
@@ -505,80 +1481,133 @@ class OrderBook ():
         return incoming
     
     
-    def update_scores_from_cross(self, standing, incoming, quantity, price):
-        s_account = standing["account"]
-        i_account = incoming["account"]
-        
-        if s_account not in self.positions:
-            self.positions[s_account] = Position()
-        if i_account not in self.positions:
-            self.positions[i_account] = Position()
-        
-        if s_account != i_account:              # Buying one's own shares does nothing
-            s_pos = self.positions[s_account]
-            i_pos = self.positions[i_account]
-            
-            if standing["direction"] == "buy":
-                s_pos.shares += quantity
-                s_pos.cents -= quantity * price
-                i_pos.shares -= quantity
-                i_pos.cents += quantity * price
+    def settle_sweep(self, incoming, standings, quantities, timestamp):
+        start = self.fill_store.add_sweep(incoming.id, standings, quantities, timestamp)
+        
+        # Everything per standing order happens in this one pass, since each trip through a lot of
+        # scattered Order objects costs more than the little done to each: its fill row, netting
+        # positions per counterparty, and sorting out which orders it closed.
+        
+        table = self.id_lookup_table
+        open_orders = self.account_open_orders
+        websockets_flag = self.websockets_flag
+        traded = dict()         # counterparty account ---> [qty, cents], in the order first traded with
+        taken = []              # Standing orders closed by this sweep that had never traded before
+        others = []             # Standing orders closed by this sweep that had
+        row = start
+        for standing, quantity in zip(standings, quantities):
+            account = standing.account
+            t = traded.get(account)
+            if t is None:
+                t = traded[account] = [0, 0]
+            t[0] += quantity
+            t[1] += quantity * standing.price
+            if standing.open or standing.fills is not None:
+                standing.add_fills(row, row + 1)
+                if not standing.open:
+                    others.append(standing)
             else:
-                s_pos.shares -= quantity
-                s_pos.cents += quantity * price
-                i_pos.shares += quantity
-                i_pos.cents -= quantity * price
+                if websockets_flag:             # Only its execution message needs the range
+                    standing.fills = [row, row + 1]
+                taken.append(standing)
+                del table[standing.id]
+                del open_orders[account][standing.id]
+            row += 1
+        incoming.add_fills(start, row)
+        
+        self.update_scores_from_sweep(incoming, traded)
+        
+        if websockets_flag:
+            self.create_execution_messages(incoming, standings, quantities, timestamp)
+        
+        if taken:
+            self.archive_taken(taken, timestamp)
+        for standing in others:
+            self.archive_order(standing)
+    
+    
+    def update_scores_from_sweep(self, incoming, traded):
+        # traded is counterparty account ---> [qty, cents], netted over the sweep, so each position
+        # is touched once per sweep. Within one sweep every counterparty is on the same side, so
+        # positions move in only one direction, and the min/max tracking sees the same extremes as
+        # it would fill by fill.
+        
+        account_numbers = self.account_numbers
+        i_number = account_numbers[incoming.account]
+        positions = self.positions
+        
+        sign = 1 if incoming.direction == BUY else -1     # Which way the incoming account's shares go
+        i_shares = 0
+        i_cents = 0
+        
+        for account, (quantity, cents) in traded.items():
+            s_number = account_numbers[account]
+            positions.open(s_number)
+            positions.open(i_number)                # After the first counterparty, as fill by fill would
+            if s_number == i_number:                # Buying one's own shares does nothing
+                continue
+            positions.trade(s_number, -sign * quantity, sign * cents)
+            i_shares += quantity
+            i_cents += cents
+        
+        if i_shares:
+            positions.trade(i_number, sign * i_shares, -sign * i_cents)
 
                 
-    def create_execution_messages(self, standing, incoming, quantity, price, timestamp):
-
-        standing_execution_msg = EXECUTION_TEMPLATE.format(
-                standing["account"], self.venue, self.symbol, json.dumps(standing),
-                standing["id"], incoming["id"], price, quantity, timestamp,
-                "false" if standing["open"] else "true", "false" if incoming["open"] else "true")
-
-        incoming_execution_msg = EXECUTION_TEMPLATE.format(
-                incoming["account"], self.venue, self.symbol, json.dumps(incoming),
-                standing["id"], incoming["id"], price, quantity, timestamp,
-                "false" if standing["open"] else "true", "false" if incoming["open"] else "true")
-
-        standing_msg_obj = WebsocketMessage(
-                account = standing["account"],
-                venue = self.venue,
-                symbol = self.symbol,
-                msgtype = EXECUTION,
-                msg = standing_execution_msg)
-                                        
-        incoming_msg_obj = WebsocketMessage(
-                account = incoming["account"],
-                venue = self.venue,
-                symbol = self.symbol,
-                msgtype = EXECUTION,
-                msg = incoming_execution_msg)
-        
-        WS_Messages.put(standing_msg_obj)
-        WS_Messages.put(incoming_msg_obj)
-
-    
-    def order_cross(self, standing, incoming, timestamp):
-        quantity = min(standing["qty"], incoming["qty"])
-        standing["qty"] -= quantity
-        standing["totalFilled"] += quantity
-        incoming["qty"] -= quantity
-        incoming["totalFilled"] += quantity
+    def create_execution_messages(self, incoming, standings, quantities, timestamp):
         
-        price = standing["price"]
+        # The incoming order's state is reported as it was straight after each fill, so rebuild
+        # those states from the final one rather than serialising the order over and over.
+        # Each standing order is only hit once per sweep, so its final state is the right one.
         
-        fill = dict(price = price, qty = quantity, ts = timestamp)
+        venue = self.venue
+        symbol = self.symbol
+        filled_at = CLOCK.render(timestamp)
         
-        for o in standing, incoming:
-            o["fills"].append(fill)
-            if o["qty"] == 0:
-                o["open"] = False
+        incoming_dict = incoming.to_dict(venue, symbol, self.fill_store)
+        all_fills = incoming_dict["fills"]
+        first = len(all_fills) - len(standings)         # Any earlier fills happened before this sweep
+        qty = incoming.qty + sum(quantities)
+        total_filled = incoming.total_filled - (qty - incoming.qty)
         
-        self.update_scores_from_cross(standing, incoming, quantity, price)
+        messages = []
         
-        if self.websockets_flag:
-            self.create_execution_messages(standing, incoming, quantity, price, timestamp)
+        for n, (standing, quantity) in enumerate(zip(standings, quantities)):
+            price = standing.price
+            qty -= quantity
+            total_filled += quantity
+            
+            incoming_dict["qty"] = qty
+            incoming_dict["totalFilled"] = total_filled
+            incoming_dict["fills"] = all_fills[:first + n + 1]
+            incoming_dict["open"] = qty > 0
+            
+            standing_complete = "false" if standing.open else "true"
+            incoming_complete = "false" if qty else "true"
+            
+            standing_execution_msg = EXECUTION_TEMPLATE.format(
+                    standing.account, venue, symbol, json.dumps(standing.to_dict(venue, symbol, self.fill_store)),
+                    standing.id, incoming.id, price, quantity, filled_at,
+                    standing_complete, incoming_complete)
 
-        return (price, quantity)
+            incoming_execution_msg = EXECUTION_TEMPLATE.format(
+                    incoming.account, venue, symbol, json.dumps(incoming_dict),
+                    standing.id, incoming.id, price, quantity, filled_at,
+                    standing_complete, incoming_complete)
+
+            messages.append(WebsocketMessage(
+                    account = standing.account,
+                    venue = venue,
+                    symbol = symbol,
+                    msgtype = EXECUTION,
+                    msg = standing_execution_msg))
+                                            
+            messages.append(WebsocketMessage(
+                    account = incoming.account,
+                    venue = venue,
+                    symbol = symbol,
+                    msgtype = EXECUTION,
+                    msg = incoming_execution_msg))
+        
+        for msg_obj in messages:
+            WS_Messages.put(msg_obj)
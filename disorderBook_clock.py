@@ -0,0 +1,59 @@
+# Timestamps for the books. Building a datetime and calling isoformat() on every order is
+# surprisingly expensive, so the clock remembers the formatted date-and-seconds prefix of the
+# last second it saw and only formats the sub-second part fresh.
+#
+# In lazy mode (the default) the books store raw integer nanoseconds wherever they record a
+# time, and only turn them into strings when something is serialised. In eager mode they store
+# the finished strings, as they always used to.
+
+import datetime
+import time
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+class Clock ():
+    def __init__(self, lazy = True):
+        self.lazy = lazy
+        self.fixed = None                   # If set, the time (in ns) it always is; for replaying the journal
+        self.cache = (None, "")             # (whole second, formatted prefix) -- swapped as one object
+        self.last = (None, "")              # (ns, result) of the last format, as a sweep's fills share one time
+
+    def now(self):
+        fixed = self.fixed
+        if fixed is None:
+            return time.time_ns()
+        return fixed
+
+    def format(self, ns):
+        last_ns, result = self.last
+        if ns == last_ns:
+            return result
+        second, sub = divmod(ns, 1000000000)
+        cached_second, prefix = self.cache
+        if second != cached_second:
+            prefix = (EPOCH + datetime.timedelta(seconds = second)).strftime("%Y-%m-%dT%H:%M:%S")
+            self.cache = (second, prefix)
+        micro = sub // 1000
+        if micro:
+            result = "{}.{:06d}Z".format(prefix, micro)     # Like isoformat(), which omits zero microseconds
+        else:
+            result = prefix + "Z"
+        self.last = (ns, result)
+        return result
+
+    def timestamp(self):
+        return self.format(self.now())
+
+    def stamp(self):                        # What the books should store for "now"
+        if self.lazy:
+            return self.now()
+        return self.format(self.now())
+
+    def render(self, stamp):                # Whatever stamp() gave ---> the string we send out
+        if stamp.__class__ is str:
+            return stamp
+        return self.format(stamp)
+
+
+CLOCK = Clock()         # Shared by every book; configure it, don't replace it
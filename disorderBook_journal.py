@@ -0,0 +1,300 @@
+# An optional append-only journal of everything that changes the books: orders, cancels, amends
+# and mass quotes, as they were accepted. Replaying it in order through the books rebuilds them.
+#
+# Each record is written to the OS (one os.write) before the response goes out, so it survives
+# the server dying. Surviving the machine dying needs an fsync, and doing one per request would
+# have every request wait on the disk. Instead a background thread fsyncs every so often, if
+# anything was written since the last time, which covers whatever arrived in between in one go
+# (group commit). A sync interval of 0 means fsync after every write, for the paranoid.
+#
+# Record layout (little-endian): a header of body length (uint32), kind (uint8) and time in
+# nanoseconds (int64), then the body. Strings are a uint16 length and UTF-8 bytes; accounts are
+# stored as JSON text, as bots can use any JSON value that Python can hash. Ints are int64.
+#
+# A record is only put together after the book has taken the request, so anything that could
+# stop it being written has to be ruled out beforehand, with check(): names too long for a
+# string, and a journal that can no longer be synced. The books check everything else.
+
+import contextlib
+import json
+import os
+import struct
+import threading
+import time
+
+ORDER = 1               # venue, symbol, account, direction, order type, price, qty
+CANCEL = 2              # venue, symbol, id
+AMEND = 3               # venue, symbol, id, flags, price, qty (flags say which of price, qty are set)
+MASS_QUOTE = 4          # venue, symbol, account, count, then count * (direction, price, qty)
+CANCEL_MANY = 5         # venue, symbol, count, then count * id
+CANCEL_ACCOUNT = 6      # venue, symbol, account
+
+HEADER = struct.Struct("<IBq")
+COUNT = struct.Struct("<I")
+LENGTH = struct.Struct("<H")
+INT = struct.Struct("<q")
+ORDER_TAIL = struct.Struct("<BBqq")
+AMEND_TAIL = struct.Struct("<qBqq")
+QUOTE = struct.Struct("<Bqq")
+
+MAX_STRING = 2 ** 16 - 1
+
+HAS_PRICE = 1
+HAS_QTY = 2
+
+DIRECTIONS = ("buy", "sell")
+ORDER_TYPES = ("limit", "market", "fill-or-kill", "immediate-or-cancel")
+
+
+def pack_string(s):
+    b = s.encode("utf-8")
+    if len(b) > MAX_STRING:
+        raise ValueError("{} bytes is too long for a journal string".format(len(b)))
+    return LENGTH.pack(len(b)) + b
+
+
+def unpack_string(body, pos):
+    n, = LENGTH.unpack_from(body, pos)
+    pos += LENGTH.size
+    return body[pos:pos + n].decode("utf-8"), pos + n
+
+
+def pack_account(account):
+    return pack_string(json.dumps(account))
+
+
+def unpack_account(body, pos):
+    text, pos = unpack_string(body, pos)
+    return json.loads(text), pos
+
+
+class Journal ():
+    def __init__(self, filename, sync_interval = 0.01):
+        self.filename = filename
+        self.fd = os.open(filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self.offset = complete_length(filename)             # Bytes in the file, i.e. where the next record goes
+        os.ftruncate(self.fd, self.offset)                  # Lose any torn record, or it would garble the next
+        self.sync_interval = sync_interval
+        self.written = 0            # Writes so far...
+        self.synced = 0             # ...and how many of them are known to be on disk
+        self.held = None            # List of records being collected by hold(), if any
+        self.error = None
+
+        if sync_interval > 0:
+            self.sync_thread = threading.Thread(target = self.syncer, daemon = True)
+            self.sync_thread.start()
+
+    def syncer(self):
+        while 1:
+            time.sleep(self.sync_interval)
+            written = self.written
+            if written != self.synced:
+                try:
+                    os.fsync(self.fd)
+                except OSError as e:
+                    self.sync_failed(e)
+                    return
+                self.synced = written
+
+    def sync_failed(self, e, action = "fsync"):
+        # No telling what reached the disk, and a later fsync succeeding wouldn't prove
+        # otherwise, so this sticks: check() refuses everything from now on.
+        if self.error is None:
+            print("Journal {}: {} failed ({}); refusing further changes".format(self.filename, action, e))
+        self.error = e
+
+    def write(self, record):
+        if self.held is not None:
+            self.held.append(record)
+            return
+        if self.error is not None:          # Anything after a torn record would be garbled anyway
+            return
+
+        # os.write() can write less than it was given (a full disk, a signal...), so keep going
+        # until it's all there. If it fails part way, the record is torn: offset stays at its
+        # start, which is where reopening the journal truncates back to.
+
+        view = memoryview(record)
+        done = 0
+        try:
+            while done < len(view):
+                done += os.write(self.fd, view[done:])
+        except OSError as e:
+            self.sync_failed(e, "write")    # The book has already changed; refuse what comes next
+            return
+        self.offset += len(record)
+        self.written += 1
+        if self.sync_interval <= 0:
+            try:
+                os.fsync(self.fd)
+            except OSError as e:
+                self.sync_failed(e)         # The book has already changed; refuse what comes next
+                return
+            self.synced = self.written
+
+    @contextlib.contextmanager
+    def hold(self):
+        # Inside this, records are collected, and written in one go on the way out. Nests.
+        if self.held is not None:
+            yield
+            return
+        self.held = []
+        try:
+            yield
+        finally:
+            records, self.held = self.held, None
+            if records:
+                self.write(b"".join(records))
+
+    def check(self, venue, symbol, *accounts):
+        # Call before changing the books. Raises the error if syncing has failed, or ValueError if
+        # a record naming these couldn't be written.
+        if self.error is not None:
+            raise self.error
+        pack_string(venue)
+        pack_string(symbol)
+        for account in accounts:
+            pack_account(account)
+
+    def sync(self):                 # Everything written so far, on disk now
+        os.fsync(self.fd)
+        self.synced = self.written
+
+    def close(self):
+        self.sync()
+        os.close(self.fd)
+
+    def record(self, kind, ts, body):
+        self.write(HEADER.pack(len(body), kind, ts) + body)
+
+    # The following take what the book methods took (or, for orders, returned), after they
+    # accepted it; ts is the time of the request in nanoseconds.
+
+    def order(self, ts, venue, symbol, order):
+        self.record(ORDER, ts, pack_string(venue) + pack_string(symbol) + pack_account(order["account"]) +
+                    ORDER_TAIL.pack(DIRECTIONS.index(order["direction"]), ORDER_TYPES.index(order["orderType"]),
+                                    order["price"], order["originalQty"]))
+
+    def cancel(self, ts, venue, symbol, id):
+        self.record(CANCEL, ts, pack_string(venue) + pack_string(symbol) + INT.pack(id))
+
+    def amend(self, ts, venue, symbol, id, price = None, qty = None):
+        flags = (HAS_PRICE if price is not None else 0) | (HAS_QTY if qty is not None else 0)
+        self.record(AMEND, ts, pack_string(venue) + pack_string(symbol) +
+                    AMEND_TAIL.pack(id, flags, int(price or 0), int(qty or 0)))
+
+    def mass_quote(self, ts, venue, symbol, account, quotes):
+        body = [pack_string(venue), pack_string(symbol), pack_account(account), COUNT.pack(len(quotes))]
+        for quote in quotes:
+            body.append(QUOTE.pack(DIRECTIONS.index(quote["direction"]), int(quote["price"]), int(quote["qty"])))
+        self.record(MASS_QUOTE, ts, b"".join(body))
+
+    def cancel_many(self, ts, venue, symbol, ids):
+        self.record(CANCEL_MANY, ts, pack_string(venue) + pack_string(symbol) + COUNT.pack(len(ids)) +
+                    b"".join(INT.pack(id) for id in ids))
+
+    def cancel_account(self, ts, venue, symbol, account):
+        self.record(CANCEL_ACCOUNT, ts, pack_string(venue) + pack_string(symbol) + pack_account(account))
+
+
+def complete_length(filename):     # Length of the file up to the end of its last complete record
+    pos = 0
+    with open(filename, "rb") as infile:
+        size = os.fstat(infile.fileno()).st_size
+        while pos + HEADER.size <= size:
+            infile.seek(pos)
+            length, kind, ts = HEADER.unpack(infile.read(HEADER.size))
+            if pos + HEADER.size + length > size:
+                break
+            pos += HEADER.size + length
+    return pos
+
+
+def read_records(filename, offset = 0):
+    # Yields (offset after the record, kind, ts, venue, symbol, args) for each complete record
+    # from offset on. args is a tuple depending on the kind, see decode(). A torn record at the
+    # end (the server died half way through a write) is ignored.
+
+    with open(filename, "rb") as infile:
+        infile.seek(offset)
+        data = infile.read()
+
+    pos = 0
+    while pos + HEADER.size <= len(data):
+        length, kind, ts = HEADER.unpack_from(data, pos)
+        end = pos + HEADER.size + length
+        if end > len(data):
+            break
+        venue, symbol, args = decode(kind, data[pos + HEADER.size:end])
+        pos = end
+        yield offset + pos, kind, ts, venue, symbol, args
+
+
+def decode(kind, body):
+    venue, pos = unpack_string(body, 0)
+    symbol, pos = unpack_string(body, pos)
+
+    if kind == ORDER:
+        account, pos = unpack_account(body, pos)
+        direction, order_type, price, qty = ORDER_TAIL.unpack_from(body, pos)
+        return venue, symbol, ({"account": account, "direction": DIRECTIONS[direction], "orderType": ORDER_TYPES[order_type],
+                                "price": price, "qty": qty}, )
+
+    if kind == CANCEL:
+        return venue, symbol, INT.unpack_from(body, pos)
+
+    if kind == AMEND:
+        id, flags, price, qty = AMEND_TAIL.unpack_from(body, pos)
+        return venue, symbol, (id, price if flags & HAS_PRICE else None, qty if flags & HAS_QTY else None)
+
+    if kind == MASS_QUOTE:
+        account, pos = unpack_account(body, pos)
+        n, = COUNT.unpack_from(body, pos)
+        pos += COUNT.size
+        quotes = []
+        for i in range(n):
+            direction, price, qty = QUOTE.unpack_from(body, pos + i * QUOTE.size)
+            quotes.append({"direction": DIRECTIONS[direction], "price": price, "qty": qty})
+        return venue, symbol, (account, quotes)
+
+    if kind == CANCEL_MANY:
+        n, = COUNT.unpack_from(body, pos)
+        pos += COUNT.size
+        return venue, symbol, ([INT.unpack_from(body, pos + i * INT.size)[0] for i in range(n)], )
+
+    if kind == CANCEL_ACCOUNT:
+        account, pos = unpack_account(body, pos)
+        return venue, symbol, (account, )
+
+    raise ValueError("Unknown journal record kind {}".format(kind))
+
+
+# Which book method each kind of record is replayed through...
+
+METHODS = {
+    ORDER: "parse_order",
+    CANCEL: "cancel_order",
+    AMEND: "amend_order",
+    MASS_QUOTE: "mass_quote",
+    CANCEL_MANY: "cancel_orders",
+    CANCEL_ACCOUNT: "cancel_account_orders",
+}
+
+
+def replay(filename, offset, book_for, clock):
+    # Runs the records from offset on through the books, with the clock stopped at each record's
+    # time, so the books come out as they were. book_for(venue, symbol) must return the book,
+    # making it if need be. Returns how many records there were.
+
+    count = 0
+    try:
+        for end, kind, ts, venue, symbol, args in read_records(filename, offset):
+            clock.fixed = ts
+            try:
+                getattr(book_for(venue, symbol), METHODS[kind])(*args)
+            except (KeyError, TypeError, ValueError):
+                pass            # Only if the journal and snapshot disagree, e.g. a lost order
+            count += 1
+    finally:
+        clock.fixed = None
+    return count
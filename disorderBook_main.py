@@ -12,23 +12,35 @@
 # http, and so on) that takes up most (90%) of the application's time.
 
 
+import contextlib
 import json
 import optparse
+import os
 import threading
+import time
 import random
 import string
 
 try:
-    from bottle import request, response, route, run
+    from bottle import hook, request, response, route, run
 except ImportError:
-    from bottle_0_12_9 import request, response, route, run     # copy in our repo
+    from bottle_0_12_9 import hook, request, response, route, run     # copy in our repo
 
+import disorderBook_archive
 import disorderBook_book
+import disorderBook_clock
+import disorderBook_journal
+import disorderBook_snapshot
 import disorderBook_ws
 
 
 all_venues = dict()         # dict: venue string ---> dict: stock string ---> OrderBook objects
 current_book_count = 0
+spill_store = None          # SpillStore shared by all books, if --archive-db was given
+journal = None              # Journal of everything that changes the books, if --journal was given
+last_snapshot = 0           # time.monotonic() of the last snapshot
+snapshot_child = None       # ForkedSave still being written, if any
+snapshot_stats = {"taken": 0, "failed": 0, "max_pause_ms": 0, "last": None}
 
 auth = dict()
 
@@ -45,7 +57,17 @@ MISSING_FIELD = {"ok": False, "error": "Incoming POST was missing required field
 URL_MISMATCH = {"ok": False, "error": "Incoming POST data disagreed with request URL"}
 BAD_TYPE = {"ok": False, "error": "A value in the POST had the wrong type"}
 BAD_VALUE = {"ok": False, "error": "Illegal value (usually a non-positive number)"}
+NAME_TOO_LONG = {"ok": False, "error": "Account, venue or symbol name too long"}
 DISABLED = {"ok": False, "error": "Disabled or not enabled. (See command line options)"}
+MISSING_PARAM = {"ok": False, "error": "Request was missing a required query parameter"}
+BAD_PARAM = {"ok": False, "error": "A query parameter had an illegal value"}
+
+MAX_PAGE = 1000         # Largest limit allowed on the account order listings without --excess
+MAX_BATCH = 1000        # Most orders allowed in one batch POST
+
+NEEDS_PAGING = {"ok": False, "error": "Without --excess, use open_only=true or limit=N (N <= {})".format(MAX_PAGE)}
+NOT_A_LIST = {"ok": False, "error": "Incoming data was not a JSON array of orders"}
+BATCH_TOO_BIG = {"ok": False, "error": "Too many orders in one batch (at most {})".format(MAX_BATCH)}
 
 # ----------------------------------------------------------------------------------------
 
@@ -78,10 +100,75 @@ def create_book_if_needed(venue, symbol):
         if opts.maxbooks > 0:
             if current_book_count + 1 > opts.maxbooks:
                 raise TooManyBooks
-        all_venues[venue][symbol] = disorderBook_book.OrderBook(venue, symbol, opts.websockets)
+        all_venues[venue][symbol] = disorderBook_book.OrderBook(venue, symbol, opts.websockets,
+                                                                check_aggregates = opts.check_aggregates,
+                                                                price_index = opts.price_index,
+                                                                spill = spill_store)
         current_book_count += 1
 
 
+def listing_params():
+
+    # The query parameters of the account order listings: open_only, since_id and limit.
+    # Could raise ValueError.
+
+    open_only = request.query.get("open_only", "false").lower()
+    if open_only not in ("true", "false", "1", "0"):
+        raise ValueError
+    open_only = open_only in ("true", "1")
+
+    since_id = int(request.query.get("since_id", -1))
+    if since_id < -1 or since_id > disorderBook_book.MAX_VALUE:
+        raise ValueError
+
+    limit = request.query.get("limit")
+    if limit is not None:
+        limit = int(limit)
+        if limit < 1 or limit > disorderBook_book.MAX_VALUE:
+            raise ValueError
+
+    return open_only, since_id, limit
+
+
+def listing_allowed(open_only, limit):
+
+    # Without --excess, only listings that can't return a stupid amount of data are allowed...
+    return opts.excess or open_only or (limit is not None and limit <= MAX_PAGE)
+
+
+@contextlib.contextmanager
+def journal_clock():
+    # For handlers to make their book calls in: gives the time to journal the change with, and
+    # stops the clock at that time until the calls are done, so every timestamp the books hand
+    # out meanwhile is the one replaying the record will give them too.
+    clock = disorderBook_clock.CLOCK
+    if not journal or clock.fixed is not None:
+        yield clock.now()
+        return
+    clock.fixed = clock.now()
+    try:
+        yield clock.fixed
+    finally:
+        clock.fixed = None
+
+
+def journal_refusal(venue, symbol, *accounts):
+    # For handlers to call before changing a book: (status, response) if the journal couldn't
+    # record the change, else None. If the journal is broken this raises, for a 500.
+    if journal:
+        try:
+            journal.check(venue, symbol, *accounts)
+        except ValueError:
+            return 400, NAME_TOO_LONG
+    return None
+
+
+def journal_hold():             # Collect a request's journal records and write them in one go
+    if journal:
+        return journal.hold()
+    return contextlib.nullcontext()
+
+
 def api_key_from_headers(headers):
     try:
         return headers.get('X-Starfighter-Authorization')
@@ -166,6 +253,39 @@ def quote(venue, symbol):
         return dict_from_exception(e)
 
 
+# This next isn't part of the official API. How much is resting at or better than the given price?
+
+@route("/ob/api/venues/<venue>/stocks/<symbol>/depth", "GET")
+def depth(venue, symbol):
+
+    try:
+        price = int(request.query["price"])
+    except KeyError:
+        response.status = 400
+        return MISSING_PARAM
+    except ValueError:
+        response.status = 400
+        return BAD_PARAM
+
+    if price < 0:
+        response.status = 400
+        return BAD_PARAM
+
+    try:
+        create_book_if_needed(venue, symbol)
+    except TooManyBooks:
+        response.status = 400
+        return BOOK_ERROR
+
+    try:
+        ret = all_venues[venue][symbol].get_depth(price)
+        assert(ret)
+        return ret
+    except Exception as e:
+        response.status = 500
+        return dict_from_exception(e)
+
+
 @route("/ob/api/venues/<venue>/stocks/<symbol>/orders/<id>", "GET")
 def status(venue, symbol, id):
 
@@ -211,10 +331,15 @@ def status(venue, symbol, id):
 @route("/ob/api/venues/<venue>/accounts/<account>/orders", "GET")
 def status_all_orders(venue, account):
 
-    # This can return a stupid amount of data and is disabled by default...
-    if not opts.excess:
+    try:
+        open_only, since_id, limit = listing_params()
+    except ValueError:
+        response.status = 400
+        return BAD_PARAM
+
+    if not listing_allowed(open_only, limit):
         response.status = 403
-        return DISABLED
+        return NEEDS_PAGING
 
     try:
 
@@ -237,7 +362,17 @@ def status_all_orders(venue, account):
 
         if venue in all_venues:
             for bk in all_venues[venue].values():
-                orders += bk.get_all_orders(account)["orders"]
+                orders += bk.get_all_orders(account, open_only, since_id, limit)["orders"]
+
+        # Ids are per book, so several books can have the same id. Merge by id, and never split
+        # a run of equal ids across pages, or since_id would skip the rest of the run.
+
+        if limit is not None and len(orders) > limit:
+            orders.sort(key = lambda order: order["id"])
+            end = limit
+            while end < len(orders) and orders[end]["id"] == orders[limit - 1]["id"]:
+                end += 1
+            del orders[end:]
 
         ret = dict()
         ret["ok"] = True
@@ -253,10 +388,15 @@ def status_all_orders(venue, account):
 @route("/ob/api/venues/<venue>/accounts/<account>/stocks/<symbol>/orders", "GET")
 def status_all_orders_one_stock(venue, account, symbol):
 
-    # This can return a stupid amount of data and is disabled by default...
-    if not opts.excess:
+    try:
+        open_only, since_id, limit = listing_params()
+    except ValueError:
+        response.status = 400
+        return BAD_PARAM
+
+    if not listing_allowed(open_only, limit):
         response.status = 403
-        return DISABLED
+        return NEEDS_PAGING
 
     try:
         create_book_if_needed(venue, symbol)
@@ -281,7 +421,7 @@ def status_all_orders_one_stock(venue, account, symbol):
                 response.status = 401
                 return AUTH_FAILURE
 
-        ret = all_venues[venue][symbol].get_all_orders(account)
+        ret = all_venues[venue][symbol].get_all_orders(account, open_only, since_id, limit)
         assert(ret)
         return ret
 
@@ -324,7 +464,15 @@ def cancel(venue, symbol, id):
                 response.status = 401
                 return AUTH_FAILURE
 
-        ret = all_venues[venue][symbol].cancel_order(id)
+        refusal = journal_refusal(venue, symbol)
+        if refusal:
+            response.status, ret = refusal
+            return ret
+
+        with journal_clock() as ts:
+            ret = all_venues[venue][symbol].cancel_order(id)
+        if journal:
+            journal.cancel(ts, venue, symbol, id)
         assert(ret)
         return ret
 
@@ -333,8 +481,14 @@ def cancel(venue, symbol, id):
         return dict_from_exception(e)
 
 
-@route("/ob/api/venues/<venue>/stocks/<symbol>/orders", "POST")
-def make_order(venue, symbol):
+# Not part of the official API: change the price and/or qty of a resting order in one step. The
+# POST body has "price" and/or "qty" (the new outstanding qty). Shrinking an order keeps its place
+# in the queue; anything else re-queues it. See OrderBook.amend_order().
+
+@route("/ob/api/venues/<venue>/stocks/<symbol>/orders/<id>/amend", "POST")
+def amend(venue, symbol, id):
+
+    id = int(id)
 
     try:
         data = str(request.body.read(), encoding="utf-8")
@@ -343,61 +497,252 @@ def make_order(venue, symbol):
         response.status = 400
         return BAD_JSON
 
-    try:
+    if not isinstance(data, dict):
+        response.status = 400
+        return BAD_TYPE
 
-        # Thanks to cite-reader for the following bug-fix:
-        # Match behavior of real Stockfighter: recognize both these forms
+    if "price" not in data and "qty" not in data:
+        response.status = 400
+        return MISSING_FIELD
 
-        if "stock" in data:
-            symbol_in_data = data["stock"]
-        elif "symbol" in data:
-            symbol_in_data = data["symbol"]
-        else:
-            symbol_in_data = symbol
+    try:
+        create_book_if_needed(venue, symbol)
+    except TooManyBooks:
+        response.status = 400
+        return BOOK_ERROR
 
-        # Note that official SF handles POSTs that lack venue and stock/symbol (using the URL instead)
+    try:
 
-        if "venue" in data:
-            venue_in_data = data["venue"]
-        else:
-            venue_in_data = venue
+        account = all_venues[venue][symbol].account_from_order_id(id)
+        if not account:
+            response.status = 404
+            return NO_SUCH_ORDER
 
-        # Various types of faulty POST...
+        failure = account_auth_failure(account, unknown_account = AUTH_WEIRDFAIL)
+        if failure:
+            response.status, ret = failure
+            return ret
 
-        if venue_in_data != venue or symbol_in_data != symbol:
-            response.status = 400
-            return URL_MISMATCH
+        refusal = journal_refusal(venue, symbol)
+        if refusal:
+            response.status, ret = refusal
+            return ret
 
         try:
-            create_book_if_needed(venue, symbol)
-        except TooManyBooks:
+            with journal_clock() as ts:
+                ret = all_venues[venue][symbol].amend_order(id, price = data.get("price"), qty = data.get("qty"))
+        except TypeError:
             response.status = 400
-            return BOOK_ERROR
+            return BAD_TYPE
+        except ValueError:
+            response.status = 400
+            return BAD_VALUE
 
-        if auth:
+        if journal:
+            journal.amend(ts, venue, symbol, id, price = data.get("price"), qty = data.get("qty"))
 
-            try:
-                account = data["account"]
-            except KeyError:
-                response.status = 400
-                return MISSING_FIELD
+        assert(ret)
+        return ret
 
-            try:
-                apikey = api_key_from_headers(request.headers)
-            except NoApiKey:
-                response.status = 401
-                return NO_AUTH_ERROR
+    except Exception as e:
+        response.status = 500
+        return dict_from_exception(e)
 
-            if account not in auth:
-                response.status = 401
-                return AUTH_FAILURE
 
-            if auth[account] != apikey:
-                response.status = 401
-                return AUTH_FAILURE
+# Not part of the official API: cancel a JSON array of order ids on one book in one go. The
+# responses come back in an array in the same order, with an error in the slot of any id that
+# doesn't exist or belongs to someone else.
+
+@route("/ob/api/venues/<venue>/stocks/<symbol>/orders/cancel", "POST")
+def cancel_many(venue, symbol):
+
+    try:
+        data = str(request.body.read(), encoding="utf-8")
+        data = json.loads(data)
+    except:
+        response.status = 400
+        return BAD_JSON
+
+    if not isinstance(data, list):
+        response.status = 400
+        return NOT_A_LIST
+
+    if len(data) > MAX_BATCH:
+        response.status = 400
+        return BATCH_TOO_BIG
+
+    try:
+        create_book_if_needed(venue, symbol)
+    except TooManyBooks:
+        response.status = 400
+        return BOOK_ERROR
+
+    try:
+
+        book_obj = all_venues[venue][symbol]
+        results = [None] * len(data)
+        allowed = []                    # (slot, id) for the ids we may cancel
+
+        for n, id in enumerate(data):
+            if type(id) is not int:
+                results[n] = BAD_TYPE
+                continue
+            account = book_obj.account_from_order_id(id)
+            if not account:
+                results[n] = NO_SUCH_ORDER
+                continue
+            failure = account_auth_failure(account, unknown_account = AUTH_WEIRDFAIL)
+            if failure:
+                results[n] = failure[1]
+                continue
+            allowed.append((n, id))
+
+        refusal = journal_refusal(venue, symbol)
+        if refusal:
+            response.status, ret = refusal
+            return ret
+
+        ids = [id for n, id in allowed]
+        with journal_clock() as ts:
+            cancelled = book_obj.cancel_orders(ids)
+        if journal and ids:
+            journal.cancel_many(ts, venue, symbol, ids)
+        for (n, id), result in zip(allowed, cancelled):
+            results[n] = result
+
+        ret = dict()
+        ret["ok"] = True
+        ret["venue"] = venue
+        ret["symbol"] = symbol
+        ret["orders"] = results
+        return ret
+
+    except Exception as e:
+        response.status = 500
+        return dict_from_exception(e)
+
+
+# Also not official: cancel all an account's open orders, on one book or a whole venue. The
+# response lists the orders that were cancelled.
+
+@route("/ob/api/venues/<venue>/accounts/<account>/orders", "DELETE")
+@route("/ob/api/venues/<venue>/accounts/<account>/orders/cancel", "POST")
+def cancel_all(venue, account):
+
+    try:
+
+        failure = account_auth_failure(account)
+        if failure:
+            response.status, ret = failure
+            return ret
+
+        orders = []
+
+        if venue in all_venues:
+            for bk in all_venues[venue].values():
+                refusal = journal_refusal(venue, bk.symbol, account)
+                if refusal:
+                    response.status, ret = refusal
+                    return ret
+
+            with journal_hold(), journal_clock() as ts:
+                for bk in all_venues[venue].values():
+                    cancelled = bk.cancel_account_orders(account)
+                    if journal and cancelled:
+                        journal.cancel_account(ts, venue, bk.symbol, account)
+                    orders += cancelled
+
+        ret = dict()
+        ret["ok"] = True
+        ret["venue"] = venue
+        ret["orders"] = orders
+        return ret
+
+    except Exception as e:
+        response.status = 500
+        return dict_from_exception(e)
+
+
+@route("/ob/api/venues/<venue>/accounts/<account>/stocks/<symbol>/orders", "DELETE")
+@route("/ob/api/venues/<venue>/accounts/<account>/stocks/<symbol>/orders/cancel", "POST")
+def cancel_all_one_stock(venue, account, symbol):
+
+    try:
+        create_book_if_needed(venue, symbol)
+    except TooManyBooks:
+        response.status = 400
+        return BOOK_ERROR
+
+    try:
+
+        failure = account_auth_failure(account)
+        if failure:
+            response.status, ret = failure
+            return ret
+
+        refusal = journal_refusal(venue, symbol, account)
+        if refusal:
+            response.status, ret = refusal
+            return ret
+
+        ret = dict()
+        ret["ok"] = True
+        ret["venue"] = venue
+        ret["symbol"] = symbol
+        with journal_clock() as ts:
+            ret["orders"] = all_venues[venue][symbol].cancel_account_orders(account)
+        if journal and ret["orders"]:
+            journal.cancel_account(ts, venue, symbol, account)
+        return ret
+
+    except Exception as e:
+        response.status = 500
+        return dict_from_exception(e)
+
+
+# Not official: replace all an account's resting orders on one book with the JSON array of
+# {"direction", "price", "qty"} quotes POSTed. Orders already at a wanted side and price keep
+# their priority. See OrderBook.mass_quote().
+
+@route("/ob/api/venues/<venue>/accounts/<account>/stocks/<symbol>/quotes", "POST")
+def mass_quote(venue, account, symbol):
+
+    try:
+        data = str(request.body.read(), encoding="utf-8")
+        data = json.loads(data)
+    except:
+        response.status = 400
+        return BAD_JSON
+
+    if not isinstance(data, list):
+        response.status = 400
+        return NOT_A_LIST
+
+    if len(data) > MAX_BATCH:
+        response.status = 400
+        return BATCH_TOO_BIG
+
+    try:
+        create_book_if_needed(venue, symbol)
+    except TooManyBooks:
+        response.status = 400
+        return BOOK_ERROR
+
+    try:
+
+        failure = account_auth_failure(account)
+        if failure:
+            response.status, ret = failure
+            return ret
+
+        refusal = journal_refusal(venue, symbol, account)
+        if refusal:
+            response.status, ret = refusal
+            return ret
 
         try:
-            ret = all_venues[venue][symbol].parse_order(data)
+            with journal_clock() as ts:
+                ret = all_venues[venue][symbol].mass_quote(account, data)
         except TypeError:
             response.status = 400
             return BAD_TYPE
@@ -408,6 +753,9 @@ def make_order(venue, symbol):
             response.status = 400
             return BAD_VALUE
 
+        if journal:
+            journal.mass_quote(ts, venue, symbol, account, data)
+
         assert(ret)
         return ret
 
@@ -416,6 +764,183 @@ def make_order(venue, symbol):
         return dict_from_exception(e)
 
 
+def url_mismatch(data, venue, symbol):
+
+    # Thanks to cite-reader for the following bug-fix:
+    # Match behavior of real Stockfighter: recognize both these forms
+
+    if "stock" in data:
+        symbol_in_data = data["stock"]
+    elif "symbol" in data:
+        symbol_in_data = data["symbol"]
+    else:
+        symbol_in_data = symbol
+
+    # Note that official SF handles POSTs that lack venue and stock/symbol (using the URL instead)
+
+    if "venue" in data:
+        venue_in_data = data["venue"]
+    else:
+        venue_in_data = venue
+
+    return venue_in_data != venue or symbol_in_data != symbol
+
+
+def account_auth_failure(account, unknown_account = AUTH_FAILURE):
+
+    # In authentication mode, returns (status, error) if the account and API key don't match up,
+    # otherwise None.
+
+    if auth:
+
+        try:
+            apikey = api_key_from_headers(request.headers)
+        except NoApiKey:
+            return 401, NO_AUTH_ERROR
+
+        if account not in auth:
+            return 401, unknown_account
+
+        if auth[account] != apikey:
+            return 401, AUTH_FAILURE
+
+    return None
+
+
+def order_auth_failure(data):
+
+    if auth:
+        try:
+            account = data["account"]
+        except KeyError:
+            return 400, MISSING_FIELD
+        return account_auth_failure(account)
+
+    return None
+
+
+def submit_order(book, data):
+
+    # Returns (status, response) for the order, after running it if it was valid.
+
+    refusal = journal_refusal(book.venue, book.symbol, data.get("account") if isinstance(data, dict) else None)
+    if refusal:
+        return refusal
+
+    try:
+        with journal_clock() as ts:
+            ret = book.parse_order(data)
+    except TypeError:
+        return 400, BAD_TYPE
+    except KeyError:
+        return 400, MISSING_FIELD
+    except ValueError:
+        return 400, BAD_VALUE
+
+    if journal:
+        journal.order(ts, book.venue, book.symbol, ret)
+
+    return 200, ret
+
+
+@route("/ob/api/venues/<venue>/stocks/<symbol>/orders", "POST")
+def make_order(venue, symbol):
+
+    try:
+        data = str(request.body.read(), encoding="utf-8")
+        data = json.loads(data)
+    except:
+        response.status = 400
+        return BAD_JSON
+
+    try:
+
+        # Various types of faulty POST...
+
+        if url_mismatch(data, venue, symbol):
+            response.status = 400
+            return URL_MISMATCH
+
+        try:
+            create_book_if_needed(venue, symbol)
+        except TooManyBooks:
+            response.status = 400
+            return BOOK_ERROR
+
+        failure = order_auth_failure(data)
+        if failure:
+            response.status, ret = failure
+            return ret
+
+        response.status, ret = submit_order(all_venues[venue][symbol], data)
+
+        assert(ret)
+        return ret
+
+    except Exception as e:
+        response.status = 500
+        return dict_from_exception(e)
+
+
+# Not part of the official API: a JSON array of orders for one book, run in order, so that a bot
+# can (say) post both sides of its quote in one request. Each order gets the same response it
+# would have got on its own, in an array in the same order. A bad order doesn't stop the rest.
+
+@route("/ob/api/venues/<venue>/stocks/<symbol>/orders/batch", "POST")
+def make_orders(venue, symbol):
+
+    try:
+        data = str(request.body.read(), encoding="utf-8")
+        data = json.loads(data)
+    except:
+        response.status = 400
+        return BAD_JSON
+
+    if not isinstance(data, list):
+        response.status = 400
+        return NOT_A_LIST
+
+    if len(data) > MAX_BATCH:
+        response.status = 400
+        return BATCH_TOO_BIG
+
+    try:
+        create_book_if_needed(venue, symbol)
+    except TooManyBooks:
+        response.status = 400
+        return BOOK_ERROR
+
+    try:
+
+        book_obj = all_venues[venue][symbol]
+        results = []
+
+        with book_obj.ticker_deferred(), journal_hold():        # One ticker message, one journal write
+            for order_data in data:
+                if not isinstance(order_data, dict):
+                    results.append(BAD_TYPE)
+                    continue
+                if url_mismatch(order_data, venue, symbol):
+                    results.append(URL_MISMATCH)
+                    continue
+                failure = order_auth_failure(order_data)
+                if failure:
+                    results.append(failure[1])
+                    continue
+                results.append(submit_order(book_obj, order_data)[1])
+
+        ret = dict()
+        ret["ok"] = True
+        ret["venue"] = venue
+        ret["symbol"] = symbol
+        ret["orders"] = results
+        return ret
+
+    except Exception as e:
+        response.status = 500
+        return dict_from_exception(e)
+
+
 # This next isn't part of the official API. FIXME? Maybe should require authentication...
 
 @route("/ob/api/venues/<venue>/stocks/<symbol>/scores", "GET")
@@ -432,14 +957,9 @@ def scores(venue, symbol):
         except KeyError:
             return "<pre>No trading activity yet.</pre>"
 
-        all_data = []
-
         book_obj = all_venues[venue][symbol]
 
-        for account, pos in book_obj.positions.items():
-            all_data.append([account, pos.cents, pos.shares, pos.minimum, pos.maximum, pos.cents + pos.shares * currentprice])
-
-        all_data = sorted(all_data, key = lambda x : x[5], reverse = True)
+        all_data = book_obj.get_scores(currentprice)        # Sorted best NAV first
 
         table_header = "Account         USD         Shares     Pos.min    Pos.max    NAV"
 
@@ -500,6 +1020,118 @@ def home():
     </pre>
     """
 
+# Snapshots are taken between requests, so that the books and the journal agree. Where we can,
+# a forked child writes them while we carry on; it's checked on here too, after each request...
+
+@hook("after_request")
+def maybe_snapshot():
+    global snapshot_child
+
+    if snapshot_child:
+        result = snapshot_child.poll()
+        if result is not None:
+            snapshot_child = None
+            record_snapshot(result)
+
+    if opts.snapshot and not snapshot_child and time.monotonic() - last_snapshot >= opts.snapshot_secs:
+        take_snapshot(background = opts.fork_snapshots and hasattr(os, "fork"))
+
+
+def take_snapshot(background = False):
+    global last_snapshot
+    global snapshot_child
+
+    starttime = time.perf_counter()
+
+    books = [bk for venue in all_venues.values() for bk in venue.values()]
+    try:
+        for bk in books:
+            bk.flush_spill()        # The child has no writer thread, so this must happen first
+    except Exception as e:          # Rows the store hasn't taken would be missing from the snapshot
+        record_snapshot({"ok": False, "error": "Archive database not writable: {}".format(e),
+                         "pause_ms": (time.perf_counter() - starttime) * 1000})
+        last_snapshot = time.monotonic()
+        return
+    offset = journal.offset if journal else 0
+    lazy = disorderBook_clock.CLOCK.lazy
+
+    if background:
+        snapshot_child = disorderBook_snapshot.ForkedSave(opts.snapshot, books, offset, lazy)
+        snapshot_child.pause = time.perf_counter() - starttime
+    else:
+        try:
+            disorderBook_snapshot.save(opts.snapshot, books, offset, lazy)
+            result = {"ok": True, "bytes": os.path.getsize(opts.snapshot)}
+        except Exception as e:
+            result = {"ok": False, "error": str(e)}
+        result["seconds"] = result["wall_seconds"] = time.perf_counter() - starttime
+        result["pause_ms"] = result["seconds"] * 1000
+        result["journal_offset"] = offset
+        record_snapshot(result)
+
+    last_snapshot = time.monotonic()
+
+
+def record_snapshot(result):
+    result["forked"] = "child_private_dirty_kb" in result
+    snapshot_stats["last"] = result
+    snapshot_stats["taken" if result["ok"] else "failed"] += 1
+    snapshot_stats["max_pause_ms"] = max(snapshot_stats["max_pause_ms"], result["pause_ms"])
+    if not result["ok"]:
+        print("Snapshot failed: {}".format(result["error"]))
+
+
+@route("/ob/api/snapshots", "GET")
+def snapshot_status():          # Not part of the official API
+    return dict(snapshot_stats, ok = True, enabled = bool(opts.snapshot), in_progress = snapshot_child is not None)
+
+
+def restore():
+
+    # Rebuilds the books from the latest snapshot (if any) plus the journal after it (if any).
+    # Books don't send websocket messages while this goes on, as nobody can be listening.
+
+    global last_snapshot
+
+    starttime = time.perf_counter()
+    offset = 0
+    restored = []
+
+    def book_for(venue, symbol):
+        create_book_if_needed(venue, symbol)
+        book_obj = all_venues[venue][symbol]
+        book_obj.websockets_flag = False
+        return book_obj
+
+    if opts.snapshot and os.path.exists(opts.snapshot):
+        header, states = disorderBook_snapshot.load(opts.snapshot)
+        if header["lazy"] != disorderBook_clock.CLOCK.lazy:
+            print("Snapshot was taken with{} --eager-timestamps; carrying on that way".format("out" if header["lazy"] else ""))
+            disorderBook_clock.CLOCK.lazy = header["lazy"]
+        offset = header["journal_offset"]
+        for state in states:
+            book_obj = book_for(state["venue"], state["symbol"])
+            book_obj.restore_state(state)
+            restored.append(book_obj)
+
+    replayed = 0
+    if journal:
+        replayed = disorderBook_journal.replay(opts.journal, offset, book_for, disorderBook_clock.CLOCK)
+
+    for venue in all_venues.values():
+        for book_obj in venue.values():
+            book_obj.websockets_flag = opts.websockets
+
+    if restored or replayed:
+        print("Restored {} books from snapshot and replayed {} journal records in {:.2f} seconds".format(
+                len(restored), replayed, time.perf_counter() - starttime))
+
+        if opts.snapshot:
+            take_snapshot()             # So the next restart needn't replay all that again
+
+    last_snapshot = time.monotonic()
+
+
 # ----------------------------------------------------------------------------------------
 
 
@@ -513,6 +1145,8 @@ def create_auth_records():
 
 def main():
     global opts
+    global spill_store
+    global journal
 
     opt_parser = optparse.OptionParser()
 
@@ -572,8 +1206,83 @@ def main():
         help = "WebSocket Port [default: %default]")
     opt_parser.set_defaults(ws_port = 8001)
 
+    opt_parser.add_option(
+        "--eager-timestamps",
+        dest   = "eager_timestamps",
+        action = "store_true",
+        help   = "Format timestamps when things happen, not when they are sent out")
+    opt_parser.set_defaults(eager_timestamps = False)
+
+    opt_parser.add_option(
+        "--check-aggregates",
+        dest   = "check_aggregates",
+        action = "store_true",
+        help   = "Debug mode: recount the books after every change to verify the running totals (slow)")
+    opt_parser.set_defaults(check_aggregates = False)
+
+    opt_parser.add_option(
+        "--price-index",
+        dest    = "price_index",
+        type    = "choice",
+        choices = disorderBook_book.PRICE_INDEXES,
+        help    = "How books index their price levels: dense (falls back to sparse for wide "
+                  "price ranges) or sparse [default: %default]")
+    opt_parser.set_defaults(price_index = "dense")
+
+    opt_parser.add_option(
+        "--archive-db",
+        dest = "archive_db",
+        type = "str",
+        help = "SQLite file to spill old orders into, so memory use doesn't grow forever")
+    opt_parser.set_defaults(archive_db = "")
+
+    opt_parser.add_option(
+        "--journal",
+        dest = "journal",
+        type = "str",
+        help = "Append everything that changes the books to this journal file")
+    opt_parser.set_defaults(journal = "")
+
+    opt_parser.add_option(
+        "--journal-sync-ms",
+        dest = "journal_sync_ms",
+        type = "int",
+        help = "Milliseconds between fsyncs of the journal; 0 to fsync every write [default: %default]")
+    opt_parser.set_defaults(journal_sync_ms = 10)
+
+    opt_parser.add_option(
+        "--snapshot",
+        dest = "snapshot",
+        type = "str",
+        help = "Save all books to this file every so often, and start from it (plus the journal) on restart")
+    opt_parser.set_defaults(snapshot = "")
+
+    opt_parser.add_option(
+        "--snapshot-secs",
+        dest = "snapshot_secs",
+        type = "float",
+        help = "Seconds between snapshots [default: %default]")
+    opt_parser.set_defaults(snapshot_secs = 60)
+
+    opt_parser.add_option(
+        "--no-fork-snapshots",
+        dest = "fork_snapshots",
+        action = "store_false",
+        help = "Write snapshots in the server process, pausing it, rather than in a forked child")
+    opt_parser.set_defaults(fork_snapshots = True)
+
     opts, __ = opt_parser.parse_args()
 
+    disorderBook_clock.CLOCK.lazy = not opts.eager_timestamps
+
+    if opts.archive_db:
+        spill_store = disorderBook_archive.SpillStore(opts.archive_db)
+
+    if opts.journal:
+        journal = disorderBook_journal.Journal(opts.journal, sync_interval = opts.journal_sync_ms / 1000)
+
+    restore()
+
     create_book_if_needed(opts.default_venue, opts.default_symbol)
 
     if opts.accounts_file:
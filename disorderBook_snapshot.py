@@ -0,0 +1,129 @@
+# Snapshots of every book, so that a restart can load the latest one and only replay the part
+# of the journal written after it, rather than the whole session.
+#
+# A snapshot file is a magic line, then a pickled header (the journal offset the snapshot is good
+# up to, the clock mode, how many books), then one pickled OrderBook.snapshot_state() per book.
+# The bulk of that is typed arrays, which pickle as raw bytes, so saving and loading run at
+# roughly the speed of the disk. The file is written to one side and renamed over the old one,
+# so there is always a complete snapshot to load, even if we die half way through.
+#
+# Pickling every book takes a while, and the server can't match orders meanwhile. Where there's
+# fork(), ForkedSave does the work in a child process instead, which sees the books frozen as
+# they were at the fork, while the parent carries on at once. The cost is copy-on-write: every
+# page either process writes to gets copied. (Python touches reference counts just by looking
+# at objects, so the child copies more than one might think; it at least turns off the garbage
+# collector, which would otherwise walk everything.) Both sides' Private_Dirty memory is reported
+# so that overhead can be watched.
+
+import gc
+import json
+import os
+import pickle
+import time
+
+MAGIC = b"disorderBook snapshot 1\n"
+
+
+def save(filename, books, journal_offset, lazy):
+    temp = filename + ".tmp"
+    with open(temp, "wb") as outfile:
+        write(outfile, books, journal_offset, lazy)
+        outfile.flush()
+        os.fsync(outfile.fileno())
+    os.replace(temp, filename)
+
+
+def write(outfile, books, journal_offset, lazy):
+    outfile.write(MAGIC)
+    header = {"journal_offset": journal_offset, "lazy": lazy, "books": len(books)}
+    pickle.dump(header, outfile, protocol = pickle.HIGHEST_PROTOCOL)
+    for book in books:
+        pickle.dump(book.snapshot_state(), outfile, protocol = pickle.HIGHEST_PROTOCOL)
+
+
+def private_dirty_kb():        # This process's Private_Dirty memory, or None if we can't tell (not Linux)
+    try:
+        with open("/proc/self/smaps_rollup") as infile:
+            for line in infile:
+                if line.startswith("Private_Dirty:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+class ForkedSave ():
+    def __init__(self, filename, books, journal_offset, lazy):
+        started = time.perf_counter()
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+
+        if pid == 0:
+
+            # The child. Whatever happens, report back and leave without running any of the
+            # parent's cleanup (os._exit), as all of that belongs to the parent.
+
+            try:
+                os.close(read_fd)
+                gc.disable()
+                save(filename, books, journal_offset, lazy)
+                result = {"ok": True, "seconds": time.perf_counter() - started, "bytes": os.path.getsize(filename)}
+            except BaseException as e:
+                result = {"ok": False, "error": str(e)}
+            try:
+                result["child_private_dirty_kb"] = private_dirty_kb()
+                os.write(write_fd, json.dumps(result).encode("utf-8"))
+            finally:
+                os._exit(0)
+
+        os.close(write_fd)
+        self.pid = pid
+        self.read_fd = read_fd
+        self.journal_offset = journal_offset
+        self.pause = time.perf_counter() - started          # How long the parent stood still
+        self.started = time.monotonic()
+
+    def poll(self):
+        # Returns None while the child is still at it, then a dict of how it went, including the
+        # parent's pause and Private_Dirty memory (which by now is mostly copy-on-write copies).
+
+        pid, status = os.waitpid(self.pid, os.WNOHANG)
+        if pid == 0:
+            return None
+
+        chunks = []
+        while 1:
+            chunk = os.read(self.read_fd, 65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        os.close(self.read_fd)
+
+        try:
+            result = json.loads(b"".join(chunks).decode("utf-8"))
+        except ValueError:
+            result = {"ok": False, "error": "Snapshot process died (wait status {})".format(status)}
+
+        result["pause_ms"] = self.pause * 1000
+        result["wall_seconds"] = time.monotonic() - self.started
+        result["parent_private_dirty_kb"] = private_dirty_kb()
+        result["journal_offset"] = self.journal_offset
+        return result
+
+
+def load(filename):
+    # Returns the header and a generator of the books' states, for OrderBook.restore_state().
+    # Raises ValueError if the file isn't a snapshot.
+
+    infile = open(filename, "rb")
+    if infile.read(len(MAGIC)) != MAGIC:
+        infile.close()
+        raise ValueError("{} is not a disorderBook snapshot".format(filename))
+    header = pickle.load(infile)
+
+    def states():
+        with infile:
+            for n in range(header["books"]):
+                yield pickle.load(infile)
+
+    return header, states()
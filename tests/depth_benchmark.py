@@ -0,0 +1,225 @@
+# How OrderBook operations scale with the size of the book. For each depth (1k to 1M resting
+# orders, half bids and half asks, across 1000 price levels each side) this grows a book and
+# times, on that book:
+#
+#   insert                  a non-crossing limit order (taken out again, untimed, to keep the depth)
+#   cancel_best / _middle / _worst
+#                           the order at the front of the best, middle and worst bid levels
+#                           (replaced, untimed, by another at the same price)
+#   get_book, get_quote
+#   sweep                   one market order that takes out the entire ask side
+#
+# Everything but get_book and sweep ought to cost about the same at every depth. With --check,
+# anything else whose median gets more than --max-growth times slower between the smallest and
+# largest depth is reported, and the exit status is 1, so creeping O(n) behaviour gets noticed.
+# (The median, because means and tails at big depths carry one-off costs that aren't about
+# depth as such, like garbage collection, or the first order archived in a chunk of old ids
+# setting up that chunk.)
+
+import csv
+import optparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import disorderBook_book
+
+
+MID = 5000
+LEVELS = 1000                   # Price levels each side
+SAMPLES = 2000                  # Timed repeats of the cheap operations
+SLOW_BUDGET = 1.0               # Seconds to spend repeating get_book, at most
+EXPECTED_TO_GROW = ("get_book", "sweep")
+
+COLUMNS = ["depth", "operation", "samples", "mean_us", "p50_us", "p99_us", "max_us"]
+
+
+def order(direction, price, qty = 10, order_type = "limit"):
+    return {"account": "DEPTH", "direction": direction, "orderType": order_type, "price": price, "qty": qty}
+
+
+def build(depth, rng, price_index):
+
+    # Returns the book, the time it took per insert, and a dict of bid price ---> ids resting
+    # there, oldest first.
+
+    book = disorderBook_book.OrderBook("BENCHEX", "DPTH", False, price_index = price_index)
+    bid_ids = {MID - 1 - n: [] for n in range(LEVELS)}
+    starttime = time.perf_counter()
+    for n in range(depth):
+        if n % 2:
+            book.parse_order(order("sell", MID + 1 + rng.randrange(LEVELS), rng.randint(1, 100)))
+        else:
+            price = MID - 1 - rng.randrange(LEVELS)
+            bid_ids[price].append(book.parse_order(order("buy", price, rng.randint(1, 100)))["id"])
+    per_insert = (time.perf_counter() - starttime) / depth
+    return book, per_insert, bid_ids
+
+
+def timed_ns(f, *args):
+    t = time.perf_counter_ns()
+    f(*args)
+    return time.perf_counter_ns() - t
+
+
+def stats(depth, operation, latencies):
+    ordered = sorted(latencies)
+    return {
+        "depth": depth,
+        "operation": operation,
+        "samples": len(ordered),
+        "mean_us": sum(ordered) / len(ordered) / 1000,
+        "p50_us": ordered[len(ordered) // 2] / 1000,
+        "p99_us": ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))] / 1000,
+        "max_us": ordered[-1] / 1000,
+    }
+
+
+def measure(depth, rng, price_index):
+    rows = []
+
+    print("Building a book of {} orders...".format(depth))
+    book, per_insert, bid_ids = build(depth, rng, price_index)
+    rows.append({"depth": depth, "operation": "build", "samples": depth, "mean_us": per_insert * 1e6,
+                 "p50_us": "", "p99_us": "", "max_us": ""})
+
+    latencies = []
+    for n in range(SAMPLES):
+        if n % 2:
+            o = order("sell", MID + 1 + rng.randrange(LEVELS))
+        else:
+            o = order("buy", MID - 1 - rng.randrange(LEVELS))
+        t = time.perf_counter_ns()
+        id = book.parse_order(o)["id"]
+        latencies.append(time.perf_counter_ns() - t)
+        book.cancel_order(id)
+    rows.append(stats(depth, "insert", latencies))
+
+    occupied = sorted((price for price, ids in bid_ids.items() if ids), reverse = True)
+    for name, price in (("best", occupied[0]), ("middle", occupied[len(occupied) // 2]), ("worst", occupied[-1])):
+        ids = bid_ids[price]
+        latencies = []
+        for n in range(SAMPLES):
+            latencies.append(timed_ns(book.cancel_order, ids.pop(0)))
+            ids.append(book.parse_order(order("buy", price))["id"])
+        rows.append(stats(depth, "cancel_" + name, latencies))
+
+    latencies = []
+    starttime = time.perf_counter()
+    while len(latencies) < SAMPLES and (len(latencies) < 3 or time.perf_counter() - starttime < SLOW_BUDGET):
+        latencies.append(timed_ns(book.get_book))
+    rows.append(stats(depth, "get_book", latencies))
+
+    rows.append(stats(depth, "get_quote", [timed_ns(book.get_quote) for n in range(SAMPLES)]))
+
+    asks = sum(level["qty"] for level in book.get_book()["asks"])
+    rows.append(stats(depth, "sweep", [timed_ns(book.parse_order, order("buy", 0, asks, "market"))]))
+    if book.get_book()["asks"]:
+        raise AssertionError("The sweep left asks in the book")
+
+    return rows
+
+
+def print_table(rows):
+    smallest = dict()
+    print()
+    print("{:>9} {:<14} {:>8} {:>12} {:>12} {:>12} {:>12} {:>10}".format("depth", "operation", "samples",
+                                                                   "mean us", "p50 us", "p99 us", "max us", "growth"))
+    for row in rows:
+        smallest.setdefault(row["operation"], row["mean_us"])
+        cells = ["{:12.2f}".format(row[k]) if row[k] != "" else "{:>12}".format("") for k in ("mean_us", "p50_us", "p99_us", "max_us")]
+        print("{:>9} {:<14} {:>8} {} {:>9.1f}x".format(row["depth"], row["operation"], row["samples"], " ".join(cells),
+                                                      row["mean_us"] / smallest[row["operation"]]))
+    print()
+
+
+def growth_problems(rows, max_growth):
+    problems = []
+    by_operation = dict()
+    for row in rows:
+        by_operation.setdefault(row["operation"], []).append(row)
+    for operation, op_rows in by_operation.items():
+        if operation in EXPECTED_TO_GROW or operation == "build" or len(op_rows) < 2:
+            continue
+        first, last = op_rows[0], op_rows[-1]
+        if last["p50_us"] > first["p50_us"] * max_growth:
+            problems.append("{}: median {:.2f} us at depth {}, {:.2f} us at depth {}".format(
+                    operation, first["p50_us"], first["depth"], last["p50_us"], last["depth"]))
+    return problems
+
+
+def main():
+
+    opt_parser = optparse.OptionParser()
+
+    opt_parser.add_option(
+        "--depths",
+        dest = "depths",
+        type = "str",
+        help = "Comma-separated book depths [default: %default]")
+    opt_parser.set_defaults(depths = "1000,10000,100000,1000000")
+
+    opt_parser.add_option(
+        "--csv",
+        dest = "csv",
+        type = "str",
+        help = "Write the results to this CSV file [default: %default]")
+    opt_parser.set_defaults(csv = "depth_benchmark.csv")
+
+    opt_parser.add_option(
+        "-s", "--seed",
+        dest = "seed",
+        type = "int",
+        help = "Random seed [default: %default]")
+    opt_parser.set_defaults(seed = 155176)
+
+    opt_parser.add_option(
+        "--price-index",
+        dest = "price_index",
+        type = "choice",
+        choices = ["dense", "sparse"],
+        help = "Price index for the books: dense or sparse [default: %default]")
+    opt_parser.set_defaults(price_index = "dense")
+
+    opt_parser.add_option(
+        "--check",
+        dest = "check",
+        action = "store_true",
+        help = "Fail if operations that should stay flat get slower with depth")
+    opt_parser.set_defaults(check = False)
+
+    opt_parser.add_option(
+        "--max-growth",
+        dest = "max_growth",
+        type = "float",
+        help = "How many times slower counts as not flat, for --check [default: %default]")
+    opt_parser.set_defaults(max_growth = 3.0)
+
+    opts, __ = opt_parser.parse_args()
+
+    rows = []
+    for depth in [int(d) for d in opts.depths.split(",")]:
+        rows.extend(measure(depth, random.Random(opts.seed), opts.price_index))
+
+    print_table(rows)
+
+    with open(opts.csv, "w", newline = "") as outfile:
+        writer = csv.DictWriter(outfile, fieldnames = COLUMNS)
+        writer.writeheader()
+        writer.writerows(rows)
+    print("Results written to {}".format(opts.csv))
+
+    if opts.check:
+        problems = growth_problems(rows, opts.max_growth)
+        for line in problems:
+            print("GREW: " + line)
+        if problems:
+            sys.exit(1)
+        print("Nothing grew more than {}x".format(opts.max_growth))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,285 @@
+# Benchmarks OrderBook directly, with no HTTP in the way, using seeded workloads so that two runs
+# (e.g. before and after a change) do exactly the same work. For each workload, every operation
+# is timed on its own, and we report ops/sec plus p50 / p99 / p99.9 latency per kind of operation.
+#
+#   python engine_benchmark.py --json before.json
+#   (make changes)
+#   python engine_benchmark.py --baseline before.json
+#
+# With --baseline, anything whose ops/sec dropped by more than --tolerance is flagged as a
+# regression, and the exit status is 1. Setting up each workload's book isn't timed.
+
+import json
+import optparse
+import os
+import platform
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import disorderBook_book
+
+
+MID = 5000
+SPREAD = 1000           # Resting orders go within this many cents either side of MID
+ORDER_TYPES = ["limit", "limit", "limit", "limit", "market", "immediate-or-cancel", "fill-or-kill"]   # As in 30_seconds.py
+
+
+def new_book(opts):
+    return disorderBook_book.OrderBook("BENCHEX", "BNCH", False, price_index = opts.price_index)
+
+
+def resting_order(rng, account = "BENCH"):          # A limit order that won't cross anything
+    direction = rng.choice(("buy", "sell"))
+    if direction == "buy":
+        price = rng.randint(MID - SPREAD, MID - 1)
+    else:
+        price = rng.randint(MID + 1, MID + SPREAD)
+    return {"account": account, "direction": direction, "orderType": "limit", "price": price, "qty": rng.randint(1, 100)}
+
+
+def prefill(book, rng, n):                          # Returns the ids of the orders added
+    return [book.parse_order(resting_order(rng, "ACC{}".format(i % 50)))["id"] for i in range(n)]
+
+
+def timed(latencies, method, arg):
+    t = time.perf_counter_ns()
+    ret = method(arg)
+    latencies.append(time.perf_counter_ns() - t)
+    return ret
+
+
+# Each workload takes (rng, opts, count) and returns a dict: operation name ---> list of latencies in ns
+
+def insert_at_depth(depth):
+    def workload(rng, opts, count):
+        book = new_book(opts)
+        prefill(book, rng, depth)
+        orders = [resting_order(rng) for n in range(count)]
+        latencies = []
+        for order in orders:
+            timed(latencies, book.parse_order, order)
+        return {"insert": latencies}
+    return workload
+
+
+def cancel_at_depth(depth):
+    def workload(rng, opts, count):
+        book = new_book(opts)
+        prefill(book, rng, depth)
+        ids = prefill(book, rng, count)
+        rng.shuffle(ids)
+        latencies = []
+        for id in ids:
+            timed(latencies, book.cancel_order, id)
+        return {"cancel": latencies}
+    return workload
+
+
+def market_sweeps(rng, opts, count):
+
+    # Each round tops the book up with a few resting orders (untimed) and then sends a market order
+    # big enough to eat through several price levels, alternately buying and selling.
+
+    book = new_book(opts)
+    prefill(book, rng, 50000)
+    latencies = []
+    for n in range(count):
+        for i in range(10):
+            book.parse_order(resting_order(rng))
+        order = {"account": "SWEEPER", "direction": "buy" if n % 2 else "sell", "orderType": "market",
+                 "price": 0, "qty": rng.randint(200, 800)}
+        timed(latencies, book.parse_order, order)
+    return {"market_sweep": latencies}
+
+
+def order_type_mix(rng, opts, count):
+
+    # The same mix 30_seconds.py sends, at prices that often cross, on top of a resting book.
+
+    book = new_book(opts)
+    prefill(book, rng, 10000)
+    results = {order_type: [] for order_type in ORDER_TYPES}
+    for n in range(count):
+        order_type = rng.choice(ORDER_TYPES)
+        order = {"account": "ACC{}".format(n % 50), "direction": rng.choice(("buy", "sell")), "orderType": order_type,
+                 "price": rng.randint(MID - SPREAD, MID + SPREAD), "qty": rng.randint(1, 100)}
+        timed(results[order_type], book.parse_order, order)
+    return results
+
+
+def extreme_bot(rng, opts, count):
+
+    # What bots/extreme_bot.py does: limit orders at random prices anywhere up to 2 ** 31 with
+    # huge sizes, cancelling the oldest once it has more than 10 out.
+
+    book = new_book(opts)
+    inserts = []
+    cancels = []
+    outstanding = []
+    for n in range(count):
+        order = {"account": "EXTREMEBOT", "direction": rng.choice(("buy", "sell")), "orderType": "limit",
+                 "price": rng.randint(0, 2 ** 31 - 1), "qty": rng.randint(1, 2 ** 31 - 1)}
+        outstanding.append(timed(inserts, book.parse_order, order)["id"])
+        if len(outstanding) > 10:
+            timed(cancels, book.cancel_order, outstanding.pop(0))
+    return {"insert": inserts, "cancel": cancels}
+
+
+WORKLOADS = [
+    ("insert_depth_0", insert_at_depth(0), 20000),
+    ("insert_depth_1k", insert_at_depth(1000), 20000),
+    ("insert_depth_10k", insert_at_depth(10000), 20000),
+    ("insert_depth_100k", insert_at_depth(100000), 20000),
+    ("cancel_depth_10k", cancel_at_depth(10000), 20000),
+    ("cancel_depth_100k", cancel_at_depth(100000), 20000),
+    ("market_sweep", market_sweeps, 10000),
+    ("order_type_mix", order_type_mix, 40000),
+    ("extreme_bot", extreme_bot, 20000),
+]
+
+
+def percentile(ordered, q):
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def summarise(latencies):
+    ordered = sorted(latencies)
+    total = sum(ordered)
+    return {
+        "count": len(ordered),
+        "ops_per_sec": len(ordered) / (total / 1e9) if total else 0,
+        "p50_us": percentile(ordered, 0.5) / 1000,
+        "p99_us": percentile(ordered, 0.99) / 1000,
+        "p999_us": percentile(ordered, 0.999) / 1000,
+        "max_us": ordered[-1] / 1000,
+    }
+
+
+def print_table(results, baseline):
+    print()
+    print("{:<20} {:<22} {:>8} {:>12} {:>10} {:>10} {:>10}{}".format(
+            "workload", "operation", "count", "ops/sec", "p50 us", "p99 us", "p99.9 us", "   vs baseline" if baseline else ""))
+    for name, ops in results.items():
+        for op, r in ops.items():
+            line = "{:<20} {:<22} {:>8} {:>12.0f} {:>10.2f} {:>10.2f} {:>10.2f}".format(
+                    name, op, r["count"], r["ops_per_sec"], r["p50_us"], r["p99_us"], r["p999_us"])
+            old = baseline.get(name, {}).get(op) if baseline else None
+            if old and old["ops_per_sec"]:
+                line += "   {:+7.1%} ops/sec, {:+7.1%} p99".format(r["ops_per_sec"] / old["ops_per_sec"] - 1,
+                                                                 r["p99_us"] / old["p99_us"] - 1 if old["p99_us"] else 0)
+            print(line)
+    print()
+
+
+def regressions(results, baseline, tolerance):
+    ret = []
+    for name, ops in results.items():
+        for op, r in ops.items():
+            old = baseline.get(name, {}).get(op)
+            if old and r["ops_per_sec"] < old["ops_per_sec"] * (1 - tolerance):
+                ret.append("{} / {}: {:.0f} ops/sec, was {:.0f}".format(name, op, r["ops_per_sec"], old["ops_per_sec"]))
+    return ret
+
+
+def main():
+
+    opt_parser = optparse.OptionParser()
+
+    opt_parser.add_option(
+        "-s", "--seed",
+        dest = "seed",
+        type = "int",
+        help = "Random seed [default: %default]")
+    opt_parser.set_defaults(seed = 155176)
+
+    opt_parser.add_option(
+        "--scale",
+        dest = "scale",
+        type = "float",
+        help = "Multiply the number of timed operations by this [default: %default]")
+    opt_parser.set_defaults(scale = 1.0)
+
+    opt_parser.add_option(
+        "--only",
+        dest = "only",
+        type = "str",
+        help = "Only run workloads whose names contain this")
+    opt_parser.set_defaults(only = "")
+
+    opt_parser.add_option(
+        "--price-index",
+        dest = "price_index",
+        type = "choice",
+        choices = ["dense", "sparse"],
+        help = "Price index for the books: dense or sparse [default: %default]")
+    opt_parser.set_defaults(price_index = "dense")
+
+    opt_parser.add_option(
+        "--json",
+        dest = "json",
+        type = "str",
+        help = "Write the results to this file, e.g. to use as a baseline later")
+    opt_parser.set_defaults(json = "")
+
+    opt_parser.add_option(
+        "--baseline",
+        dest = "baseline",
+        type = "str",
+        help = "Compare with results saved earlier with --json")
+    opt_parser.set_defaults(baseline = "")
+
+    opt_parser.add_option(
+        "--tolerance",
+        dest = "tolerance",
+        type = "float",
+        help = "Fractional drop in ops/sec that counts as a regression [default: %default]")
+    opt_parser.set_defaults(tolerance = 0.15)
+
+    opts, __ = opt_parser.parse_args()
+
+    baseline = None
+    if opts.baseline:
+        with open(opts.baseline) as infile:
+            baseline = json.load(infile)["results"]
+
+    results = dict()
+    for name, workload, count in WORKLOADS:
+        if opts.only not in name:
+            continue
+        print("Running {}...".format(name))
+        rng = random.Random("{} {}".format(opts.seed, name))        # So each workload is the same whatever else runs
+        latencies = workload(rng, opts, max(1, int(count * opts.scale)))
+        results[name] = {op: summarise(values) for op, values in latencies.items() if values}
+
+    print_table(results, baseline)
+
+    if opts.json:
+        output = {
+            "meta": {
+                "seed": opts.seed,
+                "scale": opts.scale,
+                "price_index": opts.price_index,
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            },
+            "results": results,
+        }
+        with open(opts.json, "w") as outfile:
+            json.dump(output, outfile, indent = 2)
+        print("Results written to {}".format(opts.json))
+
+    if baseline:
+        bad = regressions(results, baseline, opts.tolerance)
+        for line in bad:
+            print("REGRESSION: " + line)
+        if bad:
+            sys.exit(1)
+        print("No regressions beyond {:.0%}".format(opts.tolerance))
+
+
+if __name__ == "__main__":
+    main()
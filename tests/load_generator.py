@@ -0,0 +1,407 @@
+# An open-loop load generator for disorderBook_main.py. Unlike 30_seconds.py, which waits for each
+# response before sending the next request (so when the server slows down, the test politely slows
+# down with it and the delay never shows up in the numbers), this works out in advance when every
+# request is due, at a fixed arrival rate, and measures latency from that scheduled time. If the
+# server (or a busy connection) holds things up, the requests behind it are late, and that lateness
+# is counted, as it would be for real clients.
+#
+# Requests are a seeded mix of orders, cancels (of orders we placed that are still open), quotes and
+# orderbook reads, spread over a pool of connections which are kept alive where the server allows.
+# Give several rates to step up the load and find where the server saturates: that's where the
+# achieved rate falls short of the target and the tail latency takes off.
+#
+#   python load_generator.py --rates 200,500,1000,2000 --duration 20 --hgrm results
+#
+# Results are HdrHistogram-style: log-linear buckets (about 1% precision) and, with --hgrm, a
+# percentile distribution file per rate and request type, in the format HdrHistogram's plotter reads.
+#
+# The generator is Python too, so check the "late start" figures: if the client itself can't keep
+# up, requests start late before the server ever sees them, and more connections or a second
+# machine are needed.
+
+import collections
+import http.client
+import json
+import math
+import optparse
+import random
+import threading
+import time
+
+
+SUB_BUCKET_BITS = 8                 # 128 sub-buckets per power of two, i.e. within 1% (0.8%)
+MID = 5000
+ORDER_TYPES = ["limit", "limit", "limit", "limit", "market", "immediate-or-cancel", "fill-or-kill"]
+
+
+class Histogram ():
+
+    # Counts of latencies in microseconds. Values below 2 ** SUB_BUCKET_BITS are kept exactly; above
+    # that, each power of two is split into 2 ** (SUB_BUCKET_BITS - 1) equal buckets.
+
+    def __init__(self):
+        self.counts = collections.Counter()
+        self.total = 0
+        self.sum = 0
+        self.sum_squares = 0
+        self.max = 0
+
+    def record(self, us):
+        us = max(0, int(us))
+        shift = max(0, us.bit_length() - SUB_BUCKET_BITS)
+        self.counts[(us >> shift) << shift] += 1        # Keyed by the lowest value in the bucket
+        self.total += 1
+        self.sum += us
+        self.sum_squares += us * us
+        self.max = max(self.max, us)
+
+    def merge(self, other):
+        self.counts.update(other.counts)
+        self.total += other.total
+        self.sum += other.sum
+        self.sum_squares += other.sum_squares
+        self.max = max(self.max, other.max)
+
+    def highest_equivalent(self, value):        # The top of value's bucket
+        shift = max(0, value.bit_length() - SUB_BUCKET_BITS)
+        return value + (1 << shift) - 1
+
+    def value_at(self, percentile):
+        if self.total == 0:
+            return 0
+        wanted = max(1, math.ceil(percentile / 100 * self.total))
+        seen = 0
+        for value in sorted(self.counts):
+            seen += self.counts[value]
+            if seen >= wanted:
+                return min(self.highest_equivalent(value), self.max)
+        return self.max
+
+    def mean(self):
+        return self.sum / self.total if self.total else 0
+
+    def stdev(self):
+        if not self.total:
+            return 0
+        return math.sqrt(max(0, self.sum_squares / self.total - self.mean() ** 2))
+
+    def percentile_levels(self):
+
+        # As HdrHistogram prints them: 5 steps per halving of the distance to 100%, until the
+        # steps are finer than one sample.
+
+        levels = []
+        half = 0
+        while 2 ** half <= self.total:
+            lo = 100 * (1 - 0.5 ** half)
+            step = 100 * 0.5 ** half / 2 / 5
+            levels.extend(lo + step * i for i in range(5))
+            half += 1
+        levels.append(100.0)
+        return levels
+
+    def hgrm(self):                 # Percentile distribution text, values in milliseconds
+        lines = ["{:>12} {:>14} {:>10} {:>14}".format("Value", "Percentile", "TotalCount", "1/(1-Percentile)"), ""]
+        for level in self.percentile_levels():
+            value = self.value_at(level)
+            count = sum(n for v, n in self.counts.items() if v <= value)
+            inverse = "{:14.2f}".format(1 / (1 - level / 100)) if level < 100 else "{:>14}".format("inf")
+            lines.append("{:12.3f} {:14.12f} {:10d} {}".format(value / 1000, level / 100, count, inverse))
+        lines.append("#[Mean    = {:12.3f}, StdDeviation   = {:12.3f}]".format(self.mean() / 1000, self.stdev() / 1000))
+        lines.append("#[Max     = {:12.3f}, Total count    = {:12d}]".format(self.max / 1000, self.total))
+        lines.append("#[Buckets = {:12d}, SubBuckets     = {:12d}]".format(len(self.counts), 2 ** (SUB_BUCKET_BITS - 1)))
+        return "\n".join(lines) + "\n"
+
+
+class Plan ():
+
+    # Everything the run will send, decided up front from the seed: when each request is due
+    # (seconds after the start) and what it is.
+
+    def __init__(self, opts, rate, rng):
+        total = max(1, int(rate * opts.duration))
+        kinds, weights = zip(*opts.mix.items())
+
+        self.times = []
+        self.jobs = []
+        t = 0
+        for n in range(total):
+            self.times.append(t)
+            t += rng.expovariate(rate) if opts.poisson else 1 / rate
+            kind = rng.choices(kinds, weights)[0]
+            if kind == "order":
+                body = {"account": opts.account, "venue": opts.venue, "stock": opts.symbol,
+                        "price": rng.randint(MID - 100, MID + 100), "qty": rng.randint(1, 100),
+                        "direction": rng.choice(["buy", "sell"]), "orderType": rng.choice(ORDER_TYPES)}
+                self.jobs.append((kind, json.dumps(body)))
+            else:
+                self.jobs.append((kind, None))
+
+        self.next_job = iter(range(total))
+        self.lock = threading.Lock()
+        self.open_ids = collections.deque()     # Orders we placed that rested, for cancels to aim at
+
+    def take(self):                 # Next job number, or None when they've all gone
+        with self.lock:
+            return next(self.next_job, None)
+
+
+class Worker ():
+
+    def __init__(self, opts, plan, start):
+        self.opts = opts
+        self.plan = plan
+        self.start = start
+        self.latency = collections.defaultdict(Histogram)       # From the scheduled time
+        self.service = collections.defaultdict(Histogram)       # From when it was actually sent
+        self.late_start = Histogram()                           # How late we were in sending
+        self.errors = collections.Counter()
+        self.headers = {"Content-Type": "application/json", "X-Starfighter-Authorization": opts.api_key}
+        self.base = "/ob/api/venues/{}/stocks/{}".format(opts.venue, opts.symbol)
+        self.conn = None
+
+    def connection(self):
+        if self.conn is None:
+            self.conn = http.client.HTTPConnection(self.opts.host, self.opts.port, timeout = self.opts.timeout)
+        return self.conn
+
+    def send(self, kind, body):                 # Returns the status, and the parsed response for orders
+        if kind == "cancel":
+            try:
+                id = self.plan.open_ids.popleft()
+            except IndexError:
+                kind = "quote"                  # Nothing to cancel (yet); do something cheap instead
+        method, path = {
+            "order": ("POST", self.base + "/orders"),
+            "cancel": ("DELETE", self.base + "/orders/{}".format(id) if kind == "cancel" else None),
+            "quote": ("GET", self.base + "/quote"),
+            "book": ("GET", self.base),
+        }[kind]
+        conn = self.connection()
+        conn.request(method, path, body = body, headers = self.headers)
+        response = conn.getresponse()
+        data = response.read()
+        if response.will_close:
+            conn.close()                # It'll reopen on the next request
+        if kind == "order" and response.status == 200:
+            result = json.loads(data.decode("utf-8"))
+            if result.get("open"):
+                self.plan.open_ids.append(result["id"])
+        return kind, response.status
+
+    def run(self):
+        while 1:
+            n = self.plan.take()
+            if n is None:
+                break
+            scheduled = self.start + self.plan.times[n]
+            wait = scheduled - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+            sent = time.perf_counter()
+            kind, body = self.plan.jobs[n]
+            try:
+                kind, status = self.send(kind, body)
+                if status != 200:
+                    self.errors["HTTP {}".format(status)] += 1
+            except (OSError, http.client.HTTPException) as e:
+                self.errors[type(e).__name__] += 1
+                if self.conn:
+                    self.conn.close()
+                self.conn = None
+            done = time.perf_counter()
+            self.late_start.record((sent - scheduled) * 1e6)
+            self.latency[kind].record((done - scheduled) * 1e6)
+            self.service[kind].record((done - sent) * 1e6)
+        if self.conn:
+            self.conn.close()
+
+
+def run_rate(opts, rate, rng):
+    plan = Plan(opts, rate, rng)
+    start = time.perf_counter() + 0.2          # A moment for the threads to get going
+    workers = [Worker(opts, plan, start) for n in range(opts.connections)]
+    threads = [threading.Thread(target = worker.run) for worker in workers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    latency = collections.defaultdict(Histogram)
+    service = collections.defaultdict(Histogram)
+    late_start = Histogram()
+    errors = collections.Counter()
+    for worker in workers:
+        for kind, hist in worker.latency.items():
+            latency[kind].merge(hist)
+            latency["all"].merge(hist)
+        for kind, hist in worker.service.items():
+            service[kind].merge(hist)
+        late_start.merge(worker.late_start)
+        errors.update(worker.errors)
+
+    return {"rate": rate, "sent": len(plan.jobs), "elapsed": elapsed, "latency": latency, "service": service,
+            "late_start": late_start, "errors": errors}
+
+
+def ms(us):
+    return us / 1000
+
+
+def report(result):
+    latency = result["latency"]
+    print()
+    print("Target {:.0f}/sec, achieved {:.0f}/sec ({} requests in {:.1f} s), errors: {}".format(
+            result["rate"], result["sent"] / result["elapsed"], result["sent"], result["elapsed"],
+            dict(result["errors"]) or "none"))
+    print("Latency from scheduled send time, in ms (service time, from actual send, in brackets):")
+    print("{:<8} {:>8} {:>18} {:>18} {:>18} {:>18} {:>10}".format("", "count", "p50", "p90", "p99", "p99.9", "max"))
+    for kind in ["order", "cancel", "quote", "book", "all"]:
+        hist = latency.get(kind)
+        if not hist:
+            continue
+        service = result["service"].get(kind)
+        cells = []
+        for p in (50, 90, 99, 99.9):
+            cell = "{:.2f}".format(ms(hist.value_at(p)))
+            if service:
+                cell += " ({:.2f})".format(ms(service.value_at(p)))
+            cells.append(cell)
+        print("{:<8} {:>8} {:>18} {:>18} {:>18} {:>18} {:>10.2f}".format(kind, hist.total, *cells, ms(hist.max)))
+    late = result["late_start"]
+    print("Late start (client falling behind): p50 {:.2f} ms, p99 {:.2f} ms, max {:.2f} ms".format(
+            ms(late.value_at(50)), ms(late.value_at(99)), ms(late.max)))
+
+
+def parse_mix(text):
+    mix = dict()
+    for item in text.split(","):
+        kind, weight = item.split("=")
+        if kind not in ("order", "cancel", "quote", "book"):
+            raise ValueError("Unknown request type in mix: {}".format(kind))
+        mix[kind] = float(weight)
+    return mix
+
+
+def main():
+
+    opt_parser = optparse.OptionParser()
+
+    opt_parser.add_option(
+        "--host",
+        dest = "host",
+        type = "str",
+        help = "Server host [default: %default]")
+    opt_parser.set_defaults(host = "127.0.0.1")
+
+    opt_parser.add_option(
+        "-p", "--port",
+        dest = "port",
+        type = "int",
+        help = "Server port [default: %default]")
+    opt_parser.set_defaults(port = 8000)
+
+    opt_parser.add_option(
+        "--rates",
+        dest = "rates",
+        type = "str",
+        help = "Target requests per second; a comma-separated list steps through several [default: %default]")
+    opt_parser.set_defaults(rates = "100,200,500,1000")
+
+    opt_parser.add_option(
+        "-d", "--duration",
+        dest = "duration",
+        type = "float",
+        help = "Seconds to run at each rate [default: %default]")
+    opt_parser.set_defaults(duration = 10)
+
+    opt_parser.add_option(
+        "-c", "--connections",
+        dest = "connections",
+        type = "int",
+        help = "Concurrent connections [default: %default]")
+    opt_parser.set_defaults(connections = 50)
+
+    opt_parser.add_option(
+        "--mix",
+        dest = "mix",
+        type = "str",
+        help = "Relative weights of request types [default: %default]")
+    opt_parser.set_defaults(mix = "order=60,cancel=20,quote=10,book=10")
+
+    opt_parser.add_option(
+        "--poisson",
+        dest = "poisson",
+        action = "store_true",
+        help = "Random (Poisson) arrivals instead of evenly spaced ones")
+    opt_parser.set_defaults(poisson = False)
+
+    opt_parser.add_option(
+        "-s", "--seed",
+        dest = "seed",
+        type = "int",
+        help = "Random seed [default: %default]")
+    opt_parser.set_defaults(seed = 155176)
+
+    opt_parser.add_option(
+        "--timeout",
+        dest = "timeout",
+        type = "float",
+        help = "Seconds before a request counts as failed [default: %default]")
+    opt_parser.set_defaults(timeout = 30)
+
+    opt_parser.add_option(
+        "--hgrm",
+        dest = "hgrm",
+        type = "str",
+        help = "Write percentile distributions to files starting with this")
+    opt_parser.set_defaults(hgrm = "")
+
+    opt_parser.add_option(
+        "--account",
+        dest = "account",
+        type = "str",
+        help = "Account to trade as [default: %default]")
+    opt_parser.set_defaults(account = "EXB123456")
+
+    opt_parser.add_option(
+        "--api-key",
+        dest = "api_key",
+        type = "str",
+        help = "API key, if the server has accounts [default: %default]")
+    opt_parser.set_defaults(api_key = "exb123456")
+
+    opt_parser.add_option(
+        "--venue",
+        dest = "venue",
+        type = "str",
+        help = "Venue [default: %default]")
+    opt_parser.set_defaults(venue = "TESTEX")
+
+    opt_parser.add_option(
+        "--symbol",
+        dest = "symbol",
+        type = "str",
+        help = "Symbol [default: %default]")
+    opt_parser.set_defaults(symbol = "FOOBAR")
+
+    opts, __ = opt_parser.parse_args()
+    opts.mix = parse_mix(opts.mix)
+
+    rng = random.Random(opts.seed)
+
+    for rate in [float(r) for r in opts.rates.split(",")]:
+        print("Running at {:.0f} requests/sec for {} seconds...".format(rate, opts.duration))
+        result = run_rate(opts, rate, rng)
+        report(result)
+        if opts.hgrm:
+            for kind, hist in result["latency"].items():
+                filename = "{}_{:.0f}_{}.hgrm".format(opts.hgrm, rate, kind)
+                with open(filename, "w") as outfile:
+                    outfile.write(hist.hgrm())
+            print("Percentile distributions written to {}_{:.0f}_*.hgrm".format(opts.hgrm, rate))
+
+
+if __name__ == "__main__":
+    main()
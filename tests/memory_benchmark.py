@@ -0,0 +1,247 @@
+# How much memory OrderBook needs for what it keeps, to put numbers on the "runs out of RAM
+# eventually" issue and to check memory-saving work against. Each scenario pushes a lot of
+# orders through a fresh book under tracemalloc and looks at how much more memory is in use
+# afterwards (with the book still alive):
+#
+#   resting             orders that don't cross, so all stay open
+#   cancelled           orders placed and cancelled: closed, no fills
+#   crossed             pairs of orders that fill each other completely, between two accounts:
+#                       closed, one fill each
+#   crossed_accounts    the same, but every order from a new account, so every one of them also
+#                       gets an account number and a position
+#
+# From those: bytes per resting order, per closed order, per fill (crossed less cancelled) and
+# per account with a position (crossed_accounts less crossed). Also peak RSS, and the lines that
+# allocated the most, per scenario. (Lines in this file turning up there are the strings and
+# ints the orders were made from, which the book hangs on to, as it would the server's.)
+#
+# tracemalloc slows everything down a lot; the default million orders per scenario takes several
+# minutes. Use -n for a quicker look.
+#
+# tracemalloc's own bookkeeping is in RSS too, so for an honest peak RSS run with --no-trace,
+# which measures each scenario by RSS instead (coarser, and with no allocation sites).
+
+import gc
+import json
+import optparse
+import os
+import random
+import resource
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import disorderBook_book
+
+
+MID = 5000
+LEVELS = 1000
+
+
+def current_bytes():
+    if tracemalloc.is_tracing():
+        return tracemalloc.get_traced_memory()[0]
+    with open("/proc/self/statm") as infile:
+        return int(infile.read().split()[1]) * resource.getpagesize()
+
+
+def peak_rss_bytes():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+
+
+def order(account, direction, price, qty):
+    return {"account": account, "direction": direction, "orderType": "limit", "price": price, "qty": qty}
+
+
+# Each scenario fills the book it's given and returns how many of each thing it made
+
+def resting(book, rng, n):
+    for i in range(n):
+        if i % 2:
+            book.parse_order(order("ACC{}".format(i % 50), "sell", MID + 1 + rng.randrange(LEVELS), rng.randint(1, 100)))
+        else:
+            book.parse_order(order("ACC{}".format(i % 50), "buy", MID - 1 - rng.randrange(LEVELS), rng.randint(1, 100)))
+    return {"resting orders": n}
+
+
+def cancelled(book, rng, n):
+    for i in range(n):
+        id = book.parse_order(order("ACC{}".format(i % 50), rng.choice(("buy", "sell")), MID, rng.randint(1, 100)))["id"]
+        book.cancel_order(id)
+    return {"closed orders": n}
+
+
+def crossed_between(accounts):
+    def scenario(book, rng, n):
+        pairs = n // 2
+        for i in range(pairs):
+            price = rng.randint(MID - LEVELS, MID + LEVELS)
+            qty = rng.randint(1, 100)
+            first, second = accounts(i)
+            book.parse_order(order(first, "sell", price, qty))
+            book.parse_order(order(second, "buy", price, qty))
+        return {"closed orders": pairs * 2, "fills": pairs * 2}
+    return scenario
+
+
+SCENARIOS = [
+    ("resting", resting),
+    ("cancelled", cancelled),
+    ("crossed", crossed_between(lambda i: ("SELLER", "BUYER"))),
+    ("crossed_accounts", crossed_between(lambda i: ("S{}".format(i), "B{}".format(i)))),
+]
+
+
+def top_sites(snapshot, count):
+    snapshot = snapshot.filter_traces([tracemalloc.Filter(False, tracemalloc.__file__),
+                                       tracemalloc.Filter(False, "<frozen importlib._bootstrap>")])
+    ret = []
+    for stat in snapshot.statistics("lineno")[:count]:
+        frame = stat.traceback[0]
+        ret.append({"site": "{}:{}".format(os.path.basename(frame.filename), frame.lineno), "bytes": stat.size, "blocks": stat.count})
+    return ret
+
+
+def run_scenario(name, scenario, n, opts):
+    gc.collect()
+    before = current_bytes()
+    starttime = time.perf_counter()
+
+    book = disorderBook_book.OrderBook("BENCHEX", "MEM", False, price_index = opts.price_index)
+    counts = scenario(book, random.Random("{} {}".format(opts.seed, name)), n)
+
+    elapsed = time.perf_counter() - starttime
+    gc.collect()
+    result = {
+        "counts": counts,
+        "bytes": current_bytes() - before,
+        "seconds": elapsed,
+        "open_orders": len(book.id_lookup_table),
+        "archived_orders": len(book.archive),
+    }
+    if tracemalloc.is_tracing():
+        result["top_sites"] = top_sites(tracemalloc.take_snapshot(), opts.top)
+
+    del book
+    gc.collect()
+    return result
+
+
+def footprints(results):
+    ret = dict()
+
+    def per(scenario, thing):
+        return results[scenario]["bytes"] / results[scenario]["counts"][thing]
+
+    if "resting" in results:
+        ret["per resting order"] = per("resting", "resting orders")
+    if "cancelled" in results:
+        ret["per closed order"] = per("cancelled", "closed orders")
+        if "crossed" in results:
+            ret["per fill"] = per("crossed", "fills") - ret["per closed order"]        # One fill per closed order there
+    if "crossed" in results and "crossed_accounts" in results:
+        ret["per account position"] = (results["crossed_accounts"]["bytes"] - results["crossed"]["bytes"]) / \
+                                       results["crossed_accounts"]["counts"]["closed orders"]
+    return ret
+
+
+def main():
+
+    opt_parser = optparse.OptionParser()
+
+    opt_parser.add_option(
+        "-n", "--orders",
+        dest = "orders",
+        type = "int",
+        help = "Orders per scenario [default: %default]")
+    opt_parser.set_defaults(orders = 1000000)
+
+    opt_parser.add_option(
+        "--only",
+        dest = "only",
+        type = "str",
+        help = "Only run scenarios whose names contain this")
+    opt_parser.set_defaults(only = "")
+
+    opt_parser.add_option(
+        "--no-trace",
+        dest = "trace",
+        action = "store_false",
+        help = "Measure by RSS rather than tracemalloc (see above)")
+    opt_parser.set_defaults(trace = True)
+
+    opt_parser.add_option(
+        "--top",
+        dest = "top",
+        type = "int",
+        help = "Allocation sites to show per scenario [default: %default]")
+    opt_parser.set_defaults(top = 8)
+
+    opt_parser.add_option(
+        "-s", "--seed",
+        dest = "seed",
+        type = "int",
+        help = "Random seed [default: %default]")
+    opt_parser.set_defaults(seed = 155176)
+
+    opt_parser.add_option(
+        "--price-index",
+        dest = "price_index",
+        type = "choice",
+        choices = ["dense", "sparse"],
+        help = "Price index for the books: dense or sparse [default: %default]")
+    opt_parser.set_defaults(price_index = "dense")
+
+    opt_parser.add_option(
+        "--json",
+        dest = "json",
+        type = "str",
+        help = "Write the results to this file")
+    opt_parser.set_defaults(json = "")
+
+    opts, __ = opt_parser.parse_args()
+
+    if opts.trace:
+        tracemalloc.start()
+
+    results = dict()
+    for name, scenario in SCENARIOS:
+        if opts.only not in name:
+            continue
+        print("Running {} with {} orders...".format(name, opts.orders))
+        results[name] = run_scenario(name, scenario, opts.orders, opts)
+
+    print()
+    print("{:<18} {:>14} {:>10} {:>12} {:>12}".format("scenario", "MB", "seconds", "open", "archived"))
+    for name, r in results.items():
+        print("{:<18} {:>14.1f} {:>10.1f} {:>12} {:>12}".format(name, r["bytes"] / 1e6, r["seconds"], r["open_orders"], r["archived_orders"]))
+
+    print()
+    sizes = footprints(results)
+    for thing, size in sizes.items():
+        print("{:<24} {:>8.0f} bytes".format(thing, size))
+
+    print()
+    print("Peak RSS: {:.1f} MB{}".format(peak_rss_bytes() / 1e6, " (including tracemalloc's own overhead)" if opts.trace else ""))
+    if opts.trace:
+        print("Peak traced: {:.1f} MB".format(tracemalloc.get_traced_memory()[1] / 1e6))
+
+        for name, r in results.items():
+            print()
+            print("Top allocation sites, {}:".format(name))
+            for site in r["top_sites"]:
+                print("    {:<36} {:>10.1f} MB {:>10} blocks".format(site["site"], site["bytes"] / 1e6, site["blocks"]))
+
+    if opts.json:
+        output = {"orders": opts.orders, "traced": opts.trace, "results": results, "footprints": sizes,
+                  "peak_rss_bytes": peak_rss_bytes()}
+        with open(opts.json, "w") as outfile:
+            json.dump(output, outfile, indent = 2)
+        print()
+        print("Results written to {}".format(opts.json))
+
+
+if __name__ == "__main__":
+    main()